@@ -0,0 +1,214 @@
+"""Benchmark cerberus run end to end against simulated servers.
+
+Every server is a controller running on this machine behind fake_ssh.py,
+which can add latency and limit bandwidth like a real network. Each
+workload in workloads.py is run on a fresh project and the following are
+reported:
+
+    blocks/s   blocks finished a second
+    values/s   values finished a second
+    tail       seconds workers sat idle at the end of the run, in total
+    host cpu   cpu seconds used on the host, not counting the servers
+
+Results can be saved with --save and compared against with --baseline to
+spot regressions, eg.
+
+    python benchmarks/bench.py --save before.json
+    python benchmarks/bench.py --baseline before.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import cerberus  # noqa: E402
+
+# How many values each workload is run on by default.
+WORKLOADS = {"cpu": 20000, "tiny": 500000, "large": 50000, "skewed": 20000}
+
+# The file each run writes its results to.
+OUTPUT = "out.jsonl"
+
+# A change of more than this fraction against the baseline is flagged.
+THRESHOLD = 0.1
+
+
+def main():
+    """Run the benchmarks selected on the command line."""
+    parser = create_parser()
+    args = parser.parse_args()
+    for workload in args.workloads:
+        if workload not in WORKLOADS:
+            parser.error("unknown workload " + workload)
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = {result["workload"]: result for result in json.load(f)}
+
+    results = []
+    print("workload".ljust(10), "wall".rjust(8), "blocks/s".rjust(10),
+          "values/s".rjust(12), "tail".rjust(8), "host cpu".rjust(9))
+    for workload in args.workloads or sorted(WORKLOADS):
+        runs = sorted((bench(workload, args) for _ in range(args.repeat)),
+                      key=lambda result: result["wall"])
+        result = runs[len(runs) // 2]
+        results.append(result)
+        print(workload.ljust(10), "{:7.2f}s".format(result["wall"]),
+              "{:10.1f}".format(result["blocks/s"]),
+              "{:12.1f}".format(result["values/s"]),
+              "{:7.2f}s".format(result["tail"]),
+              "{:8.2f}s".format(result["host cpu"]),
+              compare(result, baseline.get(workload)))
+        sys.stdout.flush()
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def bench(workload, args):
+    """Run a workload once and return what was measured."""
+    root = tempfile.mkdtemp(prefix="cerberus-bench-")
+    try:
+        project = os.path.join(root, "project")
+        hosts = os.path.join(root, "hosts")
+        os.makedirs(project)
+        servers = []
+        for i in range(args.hosts):
+            name = "sim" + str(i)
+            servers.append({"location": name, "cores": args.cores,
+                            "window": 0, "user": "bench", "name": name})
+            deployed = os.path.join(hosts, name, ".cerberus", "bench")
+            os.makedirs(deployed)
+            copy_project(deployed)
+        copy_project(project)
+        with open(os.path.join(project, "cerberus.confg"), "w") as f:
+            json.dump({
+                "name": "bench", "function": workload, "file": "workloads",
+                "files": [], "remotes": servers, "local": True,
+                "mode": "single", "ssh_persist": 0, "cache_size": 0}, f)
+
+        bindir = os.path.join(root, "bin")
+        os.makedirs(bindir)
+        ssh = os.path.join(bindir, "ssh")
+        with open(ssh, "w") as f:
+            f.write("#!/bin/sh\nexec " + shlex.quote(sys.executable) + " "
+                    + shlex.quote(os.path.join(HERE, "fake_ssh.py"))
+                    + ' "$@"\n')
+        os.chmod(ssh, 0o755)
+        env = dict(
+            os.environ, PATH=bindir + os.pathsep + os.environ["PATH"],
+            BENCH_ROOT=hosts, BENCH_LATENCY=str(args.latency),
+            BENCH_BANDWIDTH=str(args.bandwidth))
+
+        command = [
+            sys.executable, os.path.join(ROOT, "cerberus.py"), "run",
+            str(args.stop or WORKLOADS[workload]), OUTPUT, "-r",
+            "--no-cache"] + shlex.split(args.run_args)
+        before = cpu_used()
+        began = time.time()
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(
+                command, cwd=project, env=env, stdout=devnull)
+        wall = time.time() - began
+        used = cpu_used() - before
+
+        # Take away what the simulated servers used.
+        for name in os.listdir(hosts):
+            for filename in os.listdir(os.path.join(hosts, name)):
+                if filename.startswith("cpu-"):
+                    with open(os.path.join(hosts, name, filename)) as f:
+                        used -= json.load(f)
+
+        with open(os.path.join(project, OUTPUT + cerberus.METRICS)) as f:
+            summary = cerberus._summarize(
+                [json.loads(line) for line in f if line.strip()])
+        blocks = sum(worker["blocks"]
+                     for worker in summary["workers"].values())
+        return {
+            "workload": workload, "wall": wall,
+            "blocks/s": blocks / wall, "values/s": summary["values"] / wall,
+            "tail": sum(summary["wall"] - worker["done"]
+                        for worker in summary["workers"].values()),
+            "host cpu": used}
+    finally:
+        shutil.rmtree(root)
+
+
+def copy_project(directory):
+    """Copy the controller and the workloads into a directory."""
+    shutil.copy(os.path.join(ROOT, "controller.py"), directory)
+    shutil.copy(os.path.join(HERE, "workloads.py"), directory)
+
+
+def cpu_used():
+    """Return the cpu seconds used by every child that has finished."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def compare(result, baseline):
+    """Describe how a result changed against the baseline, if there is one.
+    """
+    if baseline is None:
+        return ""
+    changes = []
+    for key, higher_is_better in (("values/s", True), ("host cpu", False)):
+        change = result[key] / max(baseline[key], 1e-6) - 1
+        if abs(change) > THRESHOLD:
+            worse = (change < 0) == higher_is_better
+            changes.append(key + " {:+.0%}".format(change)
+                           + (" REGRESSION" if worse else ""))
+    return ", ".join(changes)
+
+
+def create_parser():
+    """Create the argument parser for the benchmarks."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark cerberus run against simulated servers.")
+    parser.add_argument(
+        "workloads", nargs="*",
+        help="Which workloads to run, out of " + ", ".join(sorted(WORKLOADS))
+        + ". Defaults to all of them.")
+    parser.add_argument(
+        "-n", "--hosts", type=int, default=4,
+        help="How many servers to simulate. Defaults to 4.")
+    parser.add_argument(
+        "-c", "--cores", type=int, default=1,
+        help="How many cores each server uses. Defaults to 1.")
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="Seconds added to every message in each direction.")
+    parser.add_argument(
+        "--bandwidth", type=float, default=0.0,
+        help="Bytes a second each server can send or receive. Defaults to 0, "
+        "which is unlimited.")
+    parser.add_argument(
+        "--stop", type=int, default=None,
+        help="How many values to run each workload on.")
+    parser.add_argument(
+        "--repeat", type=int, default=1,
+        help="Run each workload this many times and report the median.")
+    parser.add_argument(
+        "--run-args", default="",
+        help="Extra arguments for cerberus run, eg. '-b 1000 -z'.")
+    parser.add_argument(
+        "--save", help="Write the results to this json file.")
+    parser.add_argument(
+        "--baseline", help="Compare against results saved with --save.")
+    return parser
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Stand in for ssh so that benchmarks can run servers on this machine.
+
+Commands are run in $BENCH_ROOT/<server>, which is also used as the home
+directory, with everything sent in either direction delayed by
+$BENCH_LATENCY seconds and limited to $BENCH_BANDWIDTH bytes a second (0 is
+unlimited). When the command exits the cpu time it and this relay used is
+written to a cpu-<pid> file in the server's directory so that it can be
+told apart from the host's.
+"""
+import json
+import os
+import queue
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# ssh options that are followed by a value.
+VALUE_OPTIONS = ("-o", "-p", "-S", "-l", "-F", "-L", "-R", "-i")
+
+
+def main(args):
+    """Run the command given in ssh's arguments on a simulated server."""
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        if args[i] == "-O":
+            # Control commands for a master connection, which there isn't.
+            return 0
+        i += 2 if args[i] in VALUE_OPTIONS else 1
+    server = args[i].split("@")[-1]
+    command = " ".join(args[i + 1:])
+
+    home = os.path.join(os.environ["BENCH_ROOT"], server)
+    latency = float(os.environ.get("BENCH_LATENCY", 0))
+    bandwidth = float(os.environ.get("BENCH_BANDWIDTH", 0))
+    proc = subprocess.Popen(
+        ["sh", "-c", command], cwd=home, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, env=dict(os.environ, HOME=home))
+    # The host kills ssh to abandon a server, which should stop the command
+    # as well.
+    signal.signal(signal.SIGTERM, lambda signum, frame: proc.terminate())
+
+    for source, target in ((sys.stdin.fileno(), proc.stdin.fileno()),
+                           (proc.stdout.fileno(), sys.stdout.fileno())):
+        thread = threading.Thread(
+            target=relay, args=(source, target, latency, bandwidth))
+        thread.daemon = True
+        thread.start()
+    code = proc.wait()
+
+    used = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        used += usage.ru_utime + usage.ru_stime
+    with open(os.path.join(home, "cpu-" + str(os.getpid())), "w") as f:
+        json.dump(used, f)
+    return code
+
+
+def relay(source, target, latency, bandwidth):
+    """Copy one file descriptor to another as a slow network would.
+
+    Each chunk is delivered `latency` seconds after the link has finished
+    sending it at `bandwidth` bytes a second. The target is closed once the
+    source is.
+    """
+    pending = queue.Queue()
+    writer = threading.Thread(target=deliver, args=(pending, target))
+    writer.daemon = True
+    writer.start()
+    sent = time.time()
+    while True:
+        try:
+            chunk = os.read(source, 1 << 16)
+        except OSError:
+            chunk = b""
+        sent = max(sent, time.time())
+        if bandwidth > 0:
+            sent += len(chunk) / bandwidth
+        pending.put((sent + latency, chunk))
+        if not chunk:
+            break
+    writer.join()
+
+
+def deliver(pending, target):
+    """Write each chunk from `pending` once it is due."""
+    while True:
+        due, chunk = pending.get()
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        if not chunk:
+            os.close(target)
+            return
+        view = memoryview(chunk)
+        try:
+            while len(view) > 0:
+                view = view[os.write(target, view):]
+        except OSError:
+            # The other end has gone, like a dropped connection.
+            os.close(target)
+            return
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,31 @@
+"""Synthetic functions for the benchmark suite to run.
+
+Each one stresses a different part of a run: the servers' cpus, the cost of
+each block, the amount of data sent back or the balance between servers.
+"""
+
+
+def cpu(n):
+    """Spend a millisecond or so of cpu on every value."""
+    total = 0
+    for i in range(2000):
+        total += (n * i) % 7
+    return total
+
+
+def tiny(n):
+    """Return a tiny result almost immediately."""
+    return n & 1
+
+
+def large(n):
+    """Return a result of about a kilobyte of json."""
+    return [n] * 128
+
+
+def skewed(n):
+    """Take a hundred times as long on one value in every hundred."""
+    total = 0
+    for i in range(20000 if n % 100 == 0 else 200):
+        total += (n * i) % 7
+    return total
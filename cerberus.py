@@ -2,15 +2,129 @@
 """Module docstring."""
 from __future__ import print_function, unicode_literals
 import argparse
+import array
+import asyncio
+import atexit
+import bisect
+import collections
+import functools
+import hashlib
+import importlib
 import json
-import math
 import multiprocessing
+import multiprocessing.pool
+import numbers
 import os
-import queue
+import select
+import shlex
+import shutil
+import sqlite3
+import struct
 import subprocess
 import sys
 import threading
 import time
+import traceback
+import zlib
+
+# Seconds that an idle ssh master connection is kept open after the last
+# command that used it has finished.
+SSH_PERSIST = 300
+
+# Number of blocks each server works on at once when neither the run nor
+# the server sets a window.
+WINDOW = 2
+
+# Seconds of work that the adaptive scheduler aims to put in each block.
+BLOCK_SECONDS = 2.0
+
+# Values per core in the first block sent to a worker, before its
+# throughput has been measured.
+PROBE_SIZE = 8
+
+# Blocks are made at least OVERHEAD_FACTOR times as long as the fixed cost
+# of sending a block to a worker, as measured by cerberus calibrate.
+OVERHEAD_FACTOR = 10
+
+# cerberus calibrate doubles the size of its sample blocks until one takes
+# CALIBRATE_SECONDS, trying at most CALIBRATE_SAMPLES sizes.
+CALIBRATE_SECONDS = 1.0
+CALIBRATE_SAMPLES = 20
+
+# Each worker reserves at most 1 / GUIDED of its share of the unreserved
+# values at a time, so reservations shrink as the run nears its end.
+GUIDED = 2
+
+# Added to the name of a run's output file for the file that records finished
+# blocks while the run is in progress, so that runs into different outputs
+# can go on at the same time.
+JOURNAL = ".journal"
+
+# Most seconds of finished blocks that a crash of the host can lose from the
+# journal.
+CHECKPOINT_SECONDS = 5.0
+
+# Added to the name of a run's output file for the file that the timings of
+# each block are written to, for cerberus stats.
+METRICS = ".metrics"
+
+# Directory next to cerberus.confg that run --profile writes the profile of
+# each server to, along with one for the whole run. The hot-function report
+# lists the PROFILE_TOP functions the most time was spent in.
+PROFILES = "cerberus.profile"
+PROFILE_TOP = 20
+
+# Seconds a server may take to send its profile once its work is done.
+PROFILE_WAIT = 10.0
+
+# Seconds a controller is given to exit once its session is closed before
+# it is killed.
+CONTROLLER_WAIT = 5.0
+
+# cerberus stats calls a worker a straggler if it finished more than
+# STRAGGLER_FRACTION of the run's length after the median worker.
+STRAGGLER_FRACTION = 0.05
+
+# Blocks are handed to another worker if they take LEASE_FACTOR times as
+# long as expected, or LEASE_MINIMUM seconds if that is longer.
+LEASE_FACTOR = 10
+LEASE_MINIMUM = 60.0
+
+# Where results are remembered between runs, and how many bytes of them are
+# kept by default.
+CACHE = "~/.cerberus/cache.sqlite"
+CACHE_SIZE = 1 << 30
+
+# Where the sha256 of each project file the host has read is remembered, so
+# that a file is only read again once it changes.
+DIGESTS = "~/.cerberus/digests.json"
+
+# What the function can be run on: a pool of processes, a pool of threads
+# or, for async def functions, an event loop.
+EXECUTORS = ["process", "thread", "async"]
+
+# Seconds that blocking reads wait before checking whether the run has
+# been stopped.
+POLL_TIMEOUT = 1.0
+
+# Longest line that is read from a controller during a run. Controllers
+# that only speak json send a whole block of results on one line.
+LINE_LIMIT = 1 << 30
+
+# Input files given to run --input remember where every FILE_INDEX-th line
+# starts, so that a block can be read without going through the whole file.
+FILE_INDEX = 1024
+
+# The port agents listen on by default, on the loopback interface of each
+# server.
+AGENT_PORT = 7265
+
+# Where workers added with add-worker run unless given a directory.
+WORKERS = "~/.cerberus/workers"
+
+# Master connections used during this invocation, mapped to their persist
+# window so that they can be shut down at exit when it is 0.
+_ssh_sessions = {}
 
 
 def main():
@@ -45,6 +159,15 @@ def new_project(args):
     data["files"] = []
     data["remotes"] = []
     data["local"] = args.local
+    data["mode"] = "batch" if args.batch else "single"
+    data["setup"] = args.setup
+    data["teardown"] = args.teardown
+    data["reduce"] = args.reduce
+    data["filter"] = args.filter
+    data["executor"] = args.executor
+    data["concurrency"] = args.concurrency
+    data["ssh_persist"] = args.ssh_persist
+    data["cache_size"] = args.cache_size * (1 << 20)
     return data
 
 
@@ -53,6 +176,7 @@ def add_remote(args, data):
     remote = {
         "location": args.location,
         "cores": args.cores,
+        "window": args.window,
         "user": args.user}
 
     if args.alias is not None:
@@ -60,7 +184,30 @@ def add_remote(args, data):
     else:
         name = args.location
     remote["name"] = name
+    return _add_server(remote, args, data)
+
 
+def add_worker(args, data):
+    """Add a worker that runs on this machine to the current project."""
+    location = args.directory
+    if location is None:
+        location = WORKERS + "/" + args.name
+    remote = {
+        "transport": "local",
+        "location": location,
+        "cores": args.cores,
+        "window": args.window,
+        "name": args.name}
+    return _add_server(remote, args, data)
+
+
+def _add_server(remote, args, data):
+    """Add a server or worker to the project, uploading to it if asked."""
+    if args.prefix is not None:
+        remote["prefix"] = args.prefix
+    for name in ("executor", "concurrency"):
+        if getattr(args, name) is not None:
+            remote[name] = getattr(args, name)
     for server in data["remotes"]:
         if remote["location"] == server["location"]:
             sys.exit("Server already exists in this project.")
@@ -70,22 +217,41 @@ def add_remote(args, data):
     data["remotes"].append(remote)
     data["remotes"].sort(key=lambda x: x["name"])
     if args.upload:
-        _upload_to(remote, data)
+        _deploy([remote], data)
     return data
 
 
 def add_file(args, data):
-    """Add one or more files to the current project."""
+    """Add one or more files to the current project.
+
+    Shared data files are also recorded in the project's "shared" list.
+    """
     for name in args.file:
-        data["files"].append(name)
+        if args.shared:
+            if not os.path.isfile(name):
+                sys.exit("Shared data must be a file: " + name)
+            shared = data.setdefault("shared", [])
+            if os.path.basename(name) in [
+                    os.path.basename(path) for path in shared]:
+                sys.exit("Shared data with that name already exists in "
+                         "this project: " + os.path.basename(name))
+            shared.append(name)
+        if name not in data["files"]:
+            data["files"].append(name)
     return data
 
 
 def clean_remote(args):
     """Remove the .cerberus directory from a server."""
-    ssh_args = ["ssh", args.user + "@" + args.location]
-    rm_args = ["rm", "-rf", ".cerberus"]
-    subprocess.call(ssh_args + rm_args)
+    server = {"user": args.user, "location": args.location}
+    _SshTransport(server, {}).call(["rm", "-rf", ".cerberus"])
+
+
+def disconnect(args, data):
+    """Close the shared ssh connections to every server in the project."""
+    for server in data["remotes"]:
+        _transport(server, data).close()
+    return data
 
 
 def list_data(args, data):
@@ -93,19 +259,17 @@ def list_data(args, data):
     if len(data["remotes"]) > 0:
         print("Servers:")
         for server in data["remotes"]:
-            if server["name"] == server["location"]:
-                print(server["user"] + "@" + server["location"])
-            else:
-                print(
-                    server["user"] + "@" + server["name"] + " ("
-                    + server["location"] + ")")
+            print(_transport(server, data).describe())
     else:
         print("No servers added")
 
     print("Included files and directories:")
     print(data["file"] + ".py")
-    if len(data["files"]) > 0:
-        print("\n".join(data["files"]))
+    for name in data["files"]:
+        if name in data.get("shared", []):
+            print(name + " (shared)")
+        else:
+            print(name)
     return data
 
 
@@ -120,6 +284,8 @@ def remove_remote(args, data):
         if remote["name"] == args.name:
             _remove_server(remote, data)
             data["remotes"].pop(i)
+    if "calibration" in data:
+        data["calibration"]["hosts"].pop(args.name, None)
 
     return data
 
@@ -129,6 +295,8 @@ def remove_files(args, data):
     for fname in args.file:
         if fname in data["files"]:
             data["files"].remove(fname)
+            if fname in data.get("shared", []):
+                data["shared"].remove(fname)
         elif fname == data["file"] + ".py":
             print("Main project file cannot be removed")
         else:
@@ -138,166 +306,1966 @@ def remove_files(args, data):
 
 def update_remote(args, data):
     """Upload project files to each of the servers."""
-    # TODO: upload in parallel
-    for server in data["remotes"]:
-        _upload_to(server, data)
+    _deploy(data["remotes"], data, args.jobs)
     return data
 
 
-def run(args, data):
-    """Run the project on local and remote machines."""
-    if args.stop - args.start < 1:
-        sys.exit("stop - start must be at least 1")
+def agent(args, data):
+    """Start, stop or check on the agents on the project's servers.
+
+    Local workers all run on this machine, so each one is given a port of
+    its own after the one used for the servers. Starting an agent where
+    another project already has one running on the port uses that one.
+    """
+    if len(data["remotes"]) == 0:
+        print("No servers added")
+        return data
+    width = max(len(server["name"]) for server in data["remotes"])
+    local_port = args.port
+    for server in data["remotes"]:
+        port = server.get("agent")
+        if args.action == "start":
+            port = args.port
+            if server.get("transport") == "local":
+                local_port += 1
+                port = local_port
+        elif port is None:
+            print("  " + server["name"].ljust(width), "not started")
+            continue
+
+        transport = _transport(server, data)
+        code, out, err = transport.call([
+            transport.python, ".cerberus/" + data["name"] + "/controller.py",
+            "--agent", args.action, str(port)])
+        if code != 0:
+            lines = err.strip().splitlines() or ["exit code " + str(code)]
+            print("  " + server["name"].ljust(width), "error: " + lines[-1])
+            continue
+        print("  " + server["name"].ljust(width), out.strip())
+        if args.action == "start":
+            server["agent"] = port
+        elif args.action == "stop":
+            del server["agent"]
+    return data
 
-    results = multiprocessing.Queue()
-    blocks, total_blocks = _create_blocks(args)
 
-    end_event = threading.Event()
-    end_event.clear()
-    consumers = []
+def calibrate(args, data):
+    """Measure how fast each machine runs the project's function.
+
+    Every machine runs blocks of increasing size and the time each block
+    takes is fitted to a fixed overhead plus a time per value. The results
+    are stored in the project and used by run to size blocks and share out
+    work from the start.
+    """
+    hosts = []
+    if not args.remote_only:
+        hosts.append(None)
+    if not args.local_only:
+        hosts.extend(data["remotes"])
+    if len(hosts) == 0:
+        sys.exit("No servers added")
+
+    print("Calibrating " + str(len(hosts)) + " machine(s)...")
+    sys.stdout.flush()
+    pool = multiprocessing.pool.ThreadPool(len(hosts))
     try:
-        if not args.local_only:
-            for server in data["remotes"]:
-                cons = multiprocessing.Process(
-                    name=server["name"], target=remote_runner,
-                    args=(server, blocks, results, data, end_event))
-                cons.start()
-                consumers.append(cons)
-
-        if not args.remote_only:
-            cons = multiprocessing.Process(
-                name="local", target=local_runner,
-                args=(blocks, results, data, end_event))
-            cons.start()
-            consumers.append(cons)
-
-        full_results = {}
-        complete_blocks = 0
+        outcomes = pool.map(
+            lambda server: _calibrate_host(server, data, args), hosts)
+    finally:
+        pool.close()
+        pool.join()
+
+    target = _target_hash(data)
+    calibration = data.get("calibration")
+    if calibration is None or calibration["target"] != target:
+        calibration = {"target": target, "hosts": {}}
+    width = max(len(name) for name, _, _ in outcomes)
+    for name, measured, error in outcomes:
+        if error is not None:
+            print("  " + name.ljust(width), "error: " + error)
+            continue
+        calibration["hosts"][name] = measured
+        print("  " + name.ljust(width),
+              "{:3d} cores".format(measured["cores"]),
+              "{:12.1f} values/s per core".format(measured["rate"]),
+              "{:8.1f}ms per block".format(measured["overhead"] * 1000))
+    data["calibration"] = calibration
+    return data
+
+
+def stats(args, data):
+    """Summarize where the time went in a run, by default the latest one."""
+    path = args.metrics
+    if path is None and args.output is not None:
+        path = args.output + METRICS
+    if path is None:
+        found = [name for name in os.listdir(".")
+                 if name.endswith(METRICS) and os.path.isfile(name)]
+        if len(found) > 0:
+            path = max(found, key=os.path.getmtime)
+    if path is None or not os.path.isfile(path):
+        sys.exit("No metrics found, they are written by cerberus run")
+    with open(path) as metrics:
+        records = [json.loads(line) for line in metrics if line.strip()]
+    summary = _summarize(records)
+    if summary is None:
+        sys.exit("No run found in " + path)
+
+    print("{:.1f}s".format(summary["wall"]), "to run",
+          summary["values"], "values",
+          "({:.1f} values/s)".format(
+              summary["values"] / max(summary["wall"], 1e-6)))
+    columns = ("compute", "queue", "encode", "network", "decode", "idle")
+    print("  " + "worker".ljust(12), "blocks".rjust(7), "values".rjust(10),
+          "values/s".rjust(10), *(column.rjust(8) for column in columns),
+          "done at".rjust(8), "wasted".rjust(7))
+    for name, worker in sorted(summary["workers"].items()):
+        print("  " + name[:12].ljust(12),
+              str(worker["blocks"]).rjust(7), str(worker["values"]).rjust(10),
+              "{:10.1f}".format(
+                  worker["values"] / max(worker["compute"], 1e-6)),
+              *("{:7.1f}s".format(worker[column]) for column in columns),
+              "{:7.1f}s".format(worker["done"]),
+              str(worker["wasted"]).rjust(7))
+
+    # Where the time each worker was connected went, over every worker.
+    # Queueing overlaps with the previous block running so it is left out.
+    spent = {column: sum(worker[column]
+                         for worker in summary["workers"].values())
+             for column in columns}
+    total = max(sum(spent.values()) - spent["queue"], 1e-6)
+    print("Time spent by workers:", ", ".join(
+        column + " {:.0%}".format(spent[column] / total)
+        for column in columns if column != "queue"))
+    print("Writing results on the host: {:.1f}s".format(summary["write"]))
+    if summary["stragglers"]:
+        print("Stragglers:", ", ".join(
+            name + " ({:.1f}s after the median worker)".format(late)
+            for name, late in summary["stragglers"]))
+    _print_failures(summary["failures"])
+    return data
+
+
+def _write_profiles(profiles, directory):
+    """Write the samples of each server and of the whole run to a directory.
+
+    A report of the functions the most time was spent in is printed.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name in os.listdir(directory):
+        if name.endswith(".folded"):
+            os.remove(os.path.join(directory, name))
+    total = collections.Counter()
+    for name, samples in sorted(profiles.items()):
+        _write_folded(os.path.join(directory, name + ".folded"), samples)
+        total.update(samples)
+    _write_folded(os.path.join(directory, "all.folded"), total)
+    print("Profile written to " + directory + " (" + str(
+        sum(total.values())) + " samples)")
+    for line in _profile_report(total):
+        print(line)
+
+
+def _write_folded(path, samples):
+    """Write samples as lines of a stack and its count."""
+    with open(path, "w") as f:
+        for stack, count in sorted(samples.items()):
+            f.write(stack + " " + str(count) + "\n")
+
+
+def _profile_report(samples, top=PROFILE_TOP):
+    """Return the lines of a report on the hottest functions in a profile.
+
+    Each function's self time counts the samples it was running in itself,
+    and its total time those it was anywhere on the stack for. Each stack
+    starts with the role of the process it was taken in.
+    """
+    total = sum(samples.values())
+    if total == 0:
+        return ["  no samples, the run may have been too short to profile"]
+    roles = collections.Counter()
+    own = collections.Counter()
+    inclusive = collections.Counter()
+    for stack, count in samples.items():
+        frames = stack.split(";")
+        roles[frames[0]] += count
+        own[frames[-1]] += count
+        for frame in set(frames[1:]):
+            inclusive[frame] += count
+    lines = ["  by process: " + ", ".join(
+        role + " {:.1%}".format(count / total)
+        for role, count in roles.most_common())]
+    lines.append("  " + "self".rjust(6) + "  " + "total".rjust(6)
+                 + "  function")
+    for frame, count in own.most_common(top):
+        lines.append("  {:6.1%}  {:6.1%}  ".format(
+            count / total, inclusive[frame] / total) + frame)
+    return lines
+
+
+def _summarize(records):
+    """Add up the records written by _Metrics, or return None if empty.
+
+    A resumed run has a start record for each part, and the time between
+    parts is left out.
+    """
+    summary = {"wall": 0.0, "values": 0, "write": 0.0, "workers": {},
+               "failures": {}}
+    began = None
+    last = None
+    for record in records:
+        if record["event"] == "start":
+            if began is not None:
+                summary["wall"] += last - began
+            began = last = record["time"]
+            for name in record["workers"]:
+                summary["workers"].setdefault(name, {
+                    "blocks": 0, "values": 0, "wasted": 0, "compute": 0.0,
+                    "queue": 0.0, "encode": 0.0, "network": 0.0,
+                    "decode": 0.0, "idle": 0.0, "done": 0.0})
+            continue
+        if began is None:
+            continue
+        last = record["time"]
+        if record["event"] == "end":
+            for name, problems in record["failures"].items():
+                summary["failures"].setdefault(name, []).extend(problems)
+            continue
+
+        worker = summary["workers"][record["worker"]]
+        count = record["bounds"][1] - record["bounds"][0]
+        if record["first"]:
+            worker["blocks"] += 1
+            worker["values"] += count
+            summary["values"] += count
+            summary["write"] += record["write"]
+            worker["done"] = summary["wall"] + last - began
+        else:
+            worker["wasted"] += count
+        for key in ("compute", "queue", "encode", "network", "decode",
+                    "idle"):
+            worker[key] += record.get(key, 0.0)
+    if began is None:
+        return None
+    summary["wall"] += last - began
+
+    finished = sorted(worker["done"] for worker in summary["workers"].values()
+                      if worker["blocks"] > 0)
+    summary["stragglers"] = []
+    if finished:
+        median = finished[len(finished) // 2]
+        summary["stragglers"] = sorted(
+            ((name, worker["done"] - median)
+             for name, worker in summary["workers"].items()
+             if worker["done"] - median
+             > STRAGGLER_FRACTION * summary["wall"]),
+            key=lambda pair: -pair[1])
+    return summary
+
+
+def run(args, data):
+    """Run the project on local and remote machines."""
+    source = _open_source(args)
+    low, high = source.span
+    if high - low < 1:
+        sys.exit("There must be at least 1 value to run")
+    if args.priority <= 0:
+        sys.exit("--priority must be more than 0")
+    for path in data.get("shared", []):
+        if not os.path.isfile(path):
+            sys.exit("Shared data file not found: " + path)
+
+    total = high - low
+    controller = _load_controller(data)
+    journal = _Journal(controller, args)
+    if args.resume:
+        # Before the output is opened, which empties it.
+        journal.check()
+    sink = _open_sink(args, source, data)
+    if args.resume:
+        finished = journal.replay(sink)
+    else:
+        if os.path.isfile(journal.path):
+            print("Discarding the unfinished previous run")
+        journal.create()
+        finished = []
+    ranges = _missing_ranges(low, high, finished)
+    calibration = _calibration(data)
+
+    # Only the results of single inputs are cached, not reduced or filtered
+    # blocks.
+    cache = None
+    if not args.no_cache and source.cacheable and not (
+            data.get("reduce") or data.get("filter")):
+        cache = _ResultCache(controller, data)
+        cached = 0
         try:
-            while complete_blocks < total_blocks:
-                print(
-                    "\r" + str(complete_blocks), "complete of",
-                    str(total_blocks),
-                    "(" + str(len(multiprocessing.active_children)),
-                    "consumers running)",
-                    sep=" ", end="")
-                sys.stdout.flush()
-                while not results.empty():
-                    _, result = results.get(False)      # block_id
-                    complete_blocks += 1
-                    for i in result:
-                        full_results[i[0]] = i[1]
-                time.sleep(0.5)
-        except queue.Empty:
-            pass
-        print("\r" + str(complete_blocks), "complete of", str(total_blocks),
-              sep=" ")
-        sys.stdout.flush()
+            for bounds, values in cache.lookup(ranges):
+                sink.write(bounds, values)
+                journal.record(bounds, values)
+                finished.append(bounds)
+                cached += bounds[1] - bounds[0]
+        except _SinkError as error:
+            cache.close()
+            sys.exit(str(error))
+        if cached > 0:
+            print(str(cached), "values found in the cache")
+            ranges = _missing_ranges(low, high, finished)
+    complete = total - sum(high - low for low, high in ranges)
+    metrics = _Metrics(args.metrics or args.output + METRICS, args.resume)
+    metrics.record(
+        "start", start=low, stop=high, complete=complete,
+        workers=([] if args.local_only else
+                 [server["name"] for server in data["remotes"]])
+        + ([] if args.remote_only else ["local"]))
 
-        end_event.set()
-        time.sleep(0.01)
-        for consumer in consumers:
-            consumer.join()
+    if args.block_size == 0:
+        blocks = _Scheduler(ranges, args.timeout)
+    else:
+        blocks = _BlockCursor(ranges, args.block_size, args.timeout)
+    coordinator = _Coordinator(
+        blocks, total, complete, sink, journal, cache, metrics)
 
-        json.dump(full_results, open(args.output, "w"))
+    runners = []
+    if not args.local_only:
+        for server in data["remotes"]:
+            runners.append((server["name"], functools.partial(
+                remote_runner, server, coordinator, data, args, source,
+                calibration.get(server["name"]))))
+    if not args.remote_only:
+        runners.append(("local", functools.partial(
+            local_runner, coordinator, data, source,
+            calibration.get("local"), args.profile is not None)))
+
+    if args.profile is not None:
+        # Before the local pool starts, so that its workers are sampled
+        # along with the host.
+        controller.start_profiler("host")
+    try:
+        asyncio.run(coordinator.run(runners))
+        if coordinator.error is not None:
+            sys.exit(coordinator.error)
+        if coordinator.complete < total:
+            sys.exit("All consumers stopped before the run was finished. "
+                     "Continue it with run --resume")
         print("Done")
     except KeyboardInterrupt:
-        print("\nAborting")
-        end_event.set()
-        for consumer in consumers:
-            consumer.join()
+        print("\nAborting. Continue the run later with run --resume")
+    finally:
+        sink.close()
+        journal.close(coordinator.complete >= total)
+        if cache is not None:
+            cache.close()
+        failures = blocks.report()
+        metrics.record(
+            "end", complete=coordinator.complete, failures=failures)
+        metrics.close()
+        _print_failures(failures)
+        if args.profile is not None:
+            coordinator.profiles["host"] = controller.stop_profiler()
+            _write_profiles(coordinator.profiles, args.profile)
     return data
 
 
-def _create_blocks(args):
-    """Create the blocks that will be distrubuted over the network."""
-    blocks = multiprocessing.JoinableQueue()
+class _Coordinator(object):
+    """Drive every worker of a run from one asyncio event loop.
 
-    if args.block_size == 0:
-        block_size = 10 ** math.floor(math.log10(args.stop - args.start))
+    Each worker is a coroutine that takes blocks from `blocks` and hands
+    their results to save(), which writes them straight to the sink. The
+    only processes the host starts are the controllers the workers talk to
+    and the local pool, so hundreds of servers cost file descriptors rather
+    than processes.
+    """
+
+    def __init__(self, blocks, total, complete, sink, journal, cache,
+                 metrics):
+        """Coordinate a run of `total` values, `complete` of them done."""
+        self.blocks = blocks
+        self.total = total
+        self.complete = complete
+        self.sink = sink
+        self.journal = journal
+        self.cache = cache
+        self.metrics = metrics
+        # Set once the workers should stop.
+        self.stop = None
+        self.tasks = []
+        # The samples each server sent back while profiling.
+        self.profiles = {}
+        # Why the run was stopped early, if it was.
+        self.error = None
+        # The length of the progress line last printed.
+        self.shown = 0
+
+    async def run(self, runners):
+        """Run the workers until every value is complete or they all stop.
+
+        `runners` is a list of each worker's name and a function that
+        returns the worker's coroutine.
+        """
+        self.stop = asyncio.Event()
+        self.tasks = [asyncio.ensure_future(self._supervise(name, runner))
+                      for name, runner in runners]
+        try:
+            self._print_progress()
+            while self.complete < self.total and not all(
+                    task.done() for task in self.tasks):
+                await _pause(self.stop, POLL_TIMEOUT)
+                self.blocks.expire()
+            print()
+            # The workers finish their pools with controller.finish_pool.
+            self.stop.set()
+            await asyncio.gather(*self.tasks)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+
+    def save(self, block_id, bounds, values, timings):
+        """Keep the results of a block that a worker finished."""
+        try:
+            self.complete += _save_result(
+                bounds, values, timings, self.sink, self.journal, self.cache,
+                self.metrics)
+        except _SinkError as error:
+            self.abort(str(error))
+            return
+        self._print_progress()
+        if self.complete >= self.total:
+            self.stop.set()
+
+    def abort(self, reason):
+        """Stop the run early, keeping the first reason given."""
+        if self.error is None:
+            self.error = reason
+        self.stop.set()
+
+    async def _supervise(self, name, runner):
+        """Run a worker, handing its blocks out again if it fails."""
+        try:
+            await runner()
+        except _FunctionError as error:
+            # It would fail the same way on every other worker.
+            self.abort("The function failed on " + name + ":\n" + str(error)
+                       + "Fix it and continue the run with run --resume")
+            self.blocks.release(name, "its function raised an error")
+        except Exception:
+            self.log(traceback.format_exc().rstrip())
+            self.blocks.release(name, "stopped with an error")
+
+    def log(self, message):
+        """Print a message above the progress line."""
+        print("\r" + message.ljust(self.shown))
+        self._print_progress()
+
+    def _print_progress(self):
+        """Overwrite the progress line with the current state of the run."""
+        self.shown = _print_progress(self.complete, self.total, sum(
+            1 for task in self.tasks if not task.done()))
+
+
+async def _pause(stop, seconds):
+    """Wait for `seconds`, or until `stop` is set if that is sooner."""
+    try:
+        await asyncio.wait_for(stop.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _until(stop, awaitable):
+    """Return the result of an awaitable, or None if `stop` is set first."""
+    task = asyncio.ensure_future(awaitable)
+    stopping = asyncio.ensure_future(stop.wait())
+    try:
+        await asyncio.wait(
+            [task, stopping], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopping.cancel()
+        if not task.done():
+            task.cancel()
+    if task.cancelled() or not task.done():
+        return None
+    return task.result()
+
+
+def _save_result(bounds, values, timings, sink, journal, cache, metrics):
+    """Keep the results of a block and return how many values they add.
+
+    `values` is None for a copy of a block that another worker finished
+    first, which is only recorded in the metrics.
+    """
+    if values is None:
+        metrics.record("block", bounds=bounds, first=False, **timings)
+        return 0
+    began = time.time()
+    sink.write(bounds, values)
+    journal.record(bounds, values)
+    if cache is not None:
+        cache.store(bounds, values)
+    metrics.record("block", bounds=bounds, first=True,
+                   write=time.time() - began, **timings)
+    return bounds[1] - bounds[0]
+
+
+def _print_failures(failures):
+    """List the problems each worker ran into during a run."""
+    failures = {name: problems for name, problems in failures.items()
+                if len(problems) > 0}
+    if len(failures) == 0:
+        return
+    print("Problems:")
+    for name in sorted(failures):
+        for problem in failures[name]:
+            print("  " + name + ": " + problem)
+
+
+def _calibration(data):
+    """Return what cerberus calibrate measured for each machine.
+
+    Measurements are ignored once the project's files have changed.
+    """
+    calibration = data.get("calibration")
+    if calibration is None:
+        return {}
+    if calibration["target"] != _target_hash(data):
+        print("The project has changed since it was calibrated, "
+              "run cerberus calibrate to measure it again")
+        return {}
+    return calibration["hosts"]
+
+
+def _calibrate_host(server, data, args):
+    """Measure a server, or the host if server is None.
+
+    Returns a tuple of the machine's name, what was measured and an error
+    message or None.
+    """
+    name = "local" if server is None else server["name"]
+    try:
+        if server is None:
+            return name, _calibrate_local(data, args), None
+        return name, _calibrate_remote(server, data, args), None
+    except EOFError:
+        return name, None, "lost connection"
+    except _FunctionError as error:
+        return name, None, str(error).strip().splitlines()[-1]
+    except Exception as error:
+        # Anything the project's own function raises.
+        return name, None, repr(error)
+
+
+def _calibrate_local(data, args):
+    """Measure the project's function on this machine."""
+    function = getattr(_load_project(data), data["function"])
+    controller = _load_controller(data)
+    options = _local_options(data)
+
+    cpus = _local_cores()
+    workers = controller.concurrency(cpus, options)
+    pool = controller.make_pool(workers, data["file"], options)
+    try:
+        samples = _sample(
+            lambda bounds: controller.start_block(
+                pool, function, bounds, options, workers).get(),
+            cpus, args.start)
+    finally:
+        pool.terminate()
+        pool.join()
+    return _fit(samples, cpus)
+
+
+def _calibrate_remote(server, data, args):
+    """Measure the project's function on a server, including the network."""
+    proc = _start_controller(server, data)
+    try:
+        conn = _Connection(proc, _load_controller(data))
+        conn.negotiate(False, _options(data, server))
+        # Controllers from before calibration don't say how many cpus they
+        # use.
+        cpus = server["cores"] or conn.cpus or 1
+
+        def measure(bounds):
+            conn.send_block(bounds)
+            return conn.read_result(bounds)
+        samples = _sample(measure, cpus, args.start)
+        conn.close()
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+    return _fit(samples, cpus)
+
+
+def _sample(measure, cores, start):
+    """Time blocks of doubling size until one takes CALIBRATE_SECONDS.
+
+    `measure` is called with the bounds of each block and waits for its
+    results. Returns a list of (values, seconds) pairs.
+    """
+    # The first block also pays for starting the workers.
+    measure((start, start + cores))
+    samples = []
+    size = cores * PROBE_SIZE
+    while len(samples) < CALIBRATE_SAMPLES:
+        began = time.time()
+        measure((start, start + size))
+        samples.append((size, time.time() - began))
+        if samples[-1][1] >= CALIBRATE_SECONDS:
+            break
+        size *= 2
+    return samples
+
+
+def _fit(samples, cores):
+    """Fit block times to a fixed overhead plus a time per value.
+
+    Returns the cores used, the values each core runs per second and the
+    overhead of a block in seconds.
+    """
+    mean_size = sum(size for size, _ in samples) / float(len(samples))
+    mean_time = sum(seconds for _, seconds in samples) / len(samples)
+    spread = sum((size - mean_size) ** 2 for size, _ in samples)
+    slope = 0
+    if spread > 0:
+        slope = sum((size - mean_size) * (seconds - mean_time)
+                    for size, seconds in samples) / spread
+    if slope > 0:
+        overhead = max(mean_time - slope * mean_size, 0.0)
     else:
-        block_size = args.block_size
-    low = args.start
-    high = low + block_size
+        # Too few or too noisy samples to tell the overhead apart.
+        size, seconds = samples[-1]
+        slope = max(seconds, 1e-6) / size
+        overhead = 0.0
+    return {"cores": cores, "rate": 1 / (slope * cores), "overhead": overhead}
+
+
+def _missing_ranges(start, stop, finished):
+    """Return the parts of range(start, stop) not covered by `finished`.
+
+    `finished` is a list of (low, high) bounds of blocks that are done.
+    """
+    ranges = []
+    low = start
+    for block_low, block_high in sorted(finished):
+        if block_low > low:
+            ranges.append((low, block_low))
+        low = max(low, block_high)
+    if low < stop:
+        ranges.append((low, stop))
+    return ranges
+
+
+class _Journal(object):
+    """Record finished blocks so that an interrupted run can be resumed.
+
+    The journal starts with a json line describing the run, followed by a
+    binary record for each finished block in the order they arrived. Records
+    are flushed as they are written and synced to disk every
+    CHECKPOINT_SECONDS.
+    """
+
+    RECORD = struct.Struct(">qqI")
+
+    def __init__(self, controller, args):
+        """Prepare a journal for the run described by `args`."""
+        self.controller = controller
+        self.settings = {
+            "start": args.start, "stop": args.stop, "output": args.output,
+            "format": args.format, "dtype": args.dtype}
+        for name in ("input", "grid", "step"):
+            if getattr(args, name):
+                self.settings[name] = getattr(args, name)
+        self.path = args.output + JOURNAL
+        self.file = None
+        self.synced = time.time()
+
+    def create(self):
+        """Start a new journal, replacing any left by an earlier run."""
+        self.file = open(self.path, "wb")
+        self.file.write(json.dumps(self.settings).encode("utf-8") + b"\n")
+        self._sync()
+
+    def check(self):
+        """Exit unless there is an unfinished run like this one to resume.
+        """
+        if not os.path.isfile(self.path):
+            sys.exit("No unfinished run found to resume")
+        with open(self.path, "rb") as journal:
+            settings = json.loads(journal.readline().decode("utf-8"))
+        if settings != self.settings:
+            sys.exit("The unfinished run was started with different "
+                     "arguments: " + json.dumps(settings))
+
+    def replay(self, sink):
+        """Write every recorded block to the sink and return their bounds.
+
+        The journal must have passed check(). Every finished block is
+        written again, as the output may hold blocks that were cut short
+        or never made it into the journal. A record cut short by a crash is
+        dropped, and the journal is reopened to add more blocks.
+        """
+        finished = []
+        with open(self.path, "rb") as journal:
+            journal.readline()
+            end = journal.tell()
+            while True:
+                record = journal.read(self.RECORD.size)
+                if len(record) < self.RECORD.size:
+                    break
+                low, high, length = self.RECORD.unpack(record)
+                payload = journal.read(length)
+                if len(payload) < length:
+                    break
+                sink.write((low, high), self.controller.decode_values(payload))
+                finished.append((low, high))
+                end = journal.tell()
+
+        self.file = open(self.path, "r+b")
+        self.file.seek(end)
+        self.file.truncate()
+        return finished
+
+    def record(self, bounds, values):
+        """Add a finished block to the journal."""
+        payload = self.controller.encode_values(values)
+        self.file.write(
+            self.RECORD.pack(bounds[0], bounds[1], len(payload)) + payload)
+        self.file.flush()
+        if time.time() - self.synced >= CHECKPOINT_SECONDS:
+            self._sync()
+
+    def close(self, finished):
+        """Close the journal, deleting it if the run has finished."""
+        if self.file is None:
+            return
+        if finished:
+            self.file.close()
+            os.remove(self.path)
+        else:
+            self._sync()
+            self.file.close()
+
+    def _sync(self):
+        """Make sure everything written so far is on disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.synced = time.time()
+
+
+def _print_progress(complete, total, running):
+    """Overwrite the progress line with the current state of the run.
+
+    Returns the length of the line.
+    """
+    line = (str(complete) + " of " + str(total) + " values complete ("
+            + str(running) + " consumers running)")
+    print("\r" + line, end="")
+    sys.stdout.flush()
+    return len(line)
+
+
+def _open_source(args):
+    """Return where the inputs of a run come from.
+
+    Exits if the arguments ask for more than one kind of input.
+    """
+    if args.input is not None or args.grid:
+        if args.start != 0 or args.stop is not None:
+            sys.exit("-s and stop can't be used with --input or --grid")
+        if args.step != 1:
+            sys.exit("--step can only be used with a range")
+        if args.input is not None and args.grid:
+            sys.exit("--input and --grid can't be used together")
+        if args.input is not None:
+            return _FileSource(args.input)
+        return _GridSource([_parse_axis(axis) for axis in args.grid])
+    if args.stop is None:
+        sys.exit("stop is needed unless --input or --grid is given")
+    if args.step == 0:
+        sys.exit("--step can't be 0")
+    if args.step != 1:
+        return _StridedSource(args.start, args.stop, args.step)
+    return _RangeSource(args.start, args.stop)
+
+
+def _parse_axis(text):
+    """Parse a --grid axis into its name, which may be None, and values.
+
+    An axis is start:stop[:step] for a range of integers, or a comma
+    separated list of values.
+    """
+    name = None
+    if "=" in text:
+        name, text = text.split("=", 1)
+    if ":" in text:
+        try:
+            return name, range(*[int(part) for part in text.split(":")])
+        except (TypeError, ValueError):
+            sys.exit("Bad range in --grid: " + text)
+    return name, [_parse_input(part) for part in text.split(",")]
+
+
+def _parse_input(text):
+    """Return the value a line of an input file stands for.
+
+    Lines are json, and anything else is taken to be a string.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text.strip()
+
+
+class _RangeSource(object):
+    """The integers in range(start, stop), which is what most runs use.
+
+    Each source numbers its inputs and blocks are made of the positions in
+    its `span`. Here the positions are the inputs themselves, so
+    controllers are only sent the bounds of each block.
+    """
+
+    # Whether the results of a block can be cached by its bounds.
+    cacheable = True
+
+    def __init__(self, start, stop):
+        """Make the source of range(start, stop)."""
+        self.span = (start, stop)
+
+    def inputs(self, bounds):
+        """Return the inputs at the positions in range(*bounds)."""
+        return range(*bounds)
+
+    def shipped(self, bounds):
+        """Return the inputs to send with a block, or None for a range."""
+        return None
+
+
+class _StridedSource(_RangeSource):
+    """The integers in range(start, stop, step)."""
+
+    cacheable = False
+
+    def __init__(self, start, stop, step):
+        """Make the source of range(start, stop, step)."""
+        self.values = range(start, stop, step)
+        self.span = (0, len(self.values))
+
+    def inputs(self, bounds):
+        """Return the inputs at the positions in range(*bounds)."""
+        return self.values[bounds[0]:bounds[1]]
+
+    def shipped(self, bounds):
+        """Return the inputs to send with a block."""
+        return list(self.inputs(bounds))
+
+
+class _GridSource(_StridedSource):
+    """Every combination of the values of several axes.
+
+    Each input is a dict from axis name to value if every axis is named,
+    and a list of values otherwise. The last axis changes fastest.
+    """
+
+    def __init__(self, axes):
+        """Make the source of the product of a list of (name, values)."""
+        self.names = [name for name, _ in axes]
+        self.axes = [values for _, values in axes]
+        count = 1
+        for values in self.axes:
+            count *= len(values)
+        self.span = (0, count)
+
+    def inputs(self, bounds):
+        """Return the inputs at the positions in range(*bounds)."""
+        inputs = []
+        for position in range(*bounds):
+            point = []
+            for values in reversed(self.axes):
+                position, index = divmod(position, len(values))
+                point.append(values[index])
+            point.reverse()
+            if None in self.names:
+                inputs.append(point)
+            else:
+                inputs.append(dict(zip(self.names, point)))
+        return inputs
+
+
+class _FileSource(_StridedSource):
+    """The values in a file, one per line.
+
+    Blank lines are skipped. The file is read once up front to find where
+    its lines start and then again a block at a time, so it never has to fit
+    in memory.
+    """
+
+    def __init__(self, path):
+        """Index the lines of the file at `path`."""
+        self.path = path
+        self.offsets = []
+        count = 0
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    if count % FILE_INDEX == 0:
+                        self.offsets.append(offset)
+                    count += 1
+                offset += len(line)
+        self.span = (0, count)
+        self.file = None
+        self.pid = None
+
+    def __getstate__(self):
+        """Leave the open file behind when sent to another process."""
+        state = dict(self.__dict__)
+        state["file"] = state["pid"] = None
+        return state
+
+    def inputs(self, bounds):
+        """Return the inputs at the positions in range(*bounds)."""
+        start, stop = bounds
+        if self.file is None or self.pid != os.getpid():
+            self.file = open(self.path, "rb")
+            self.pid = os.getpid()
+        self.file.seek(self.offsets[start // FILE_INDEX])
+        skip = start % FILE_INDEX
+        inputs = []
+        while len(inputs) < stop - start:
+            line = self.file.readline()
+            if not line:
+                raise IOError(self.path + " changed during the run")
+            if not line.strip():
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            inputs.append(_parse_input(line.decode("utf-8")))
+        return inputs
+
+
+def _open_sink(args, source, data):
+    """Open the output file of a run in the format it asks for.
+
+    Exits if the format doesn't suit the project's results.
+    """
+    if data.get("reduce"):
+        if args.format not in (None, "json"):
+            sys.exit("Reduced runs can only write json")
+        return _ReduceSink(
+            args, source, getattr(_load_project(data), data["reduce"]))
+    output_format = args.format
+    if output_format is None:
+        extension = os.path.splitext(args.output)[1].lstrip(".")
+        output_format = extension if extension in SINKS else "json"
+    if data.get("filter") and output_format == "npy":
+        sys.exit("Filtered runs can't be written as an array")
+    return SINKS[output_format](args, source, data.get("filter", False))
+
+
+class _SinkError(Exception):
+    """Results can't be written in the output's format."""
+
+
+class _Sink(object):
+    """Write the results of a run to disk as each block arrives.
+
+    Blocks are identified by the bounds of their positions in the run's
+    source, which also gives the inputs for them. In a filtered run each
+    block's results are instead the [input, result] pairs that were kept.
+    """
+
+    # How the output file is opened.
+    mode = "wb"
+
+    def __init__(self, args, source, filtered=False):
+        """Open the output file named in the run's arguments."""
+        self.file = open(args.output, self.mode)
+        self.source = source
+        self.filtered = filtered
+
+    def __enter__(self):
+        """Return the sink itself."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Finish the output file."""
+        self.close()
+
+    def write(self, bounds, values):
+        """Write the results of the block covering range(*bounds)."""
+        if self.filtered:
+            self.write_pairs(values)
+        else:
+            self.write_pairs(zip(self.source.inputs(bounds), values))
+
+    def write_pairs(self, pairs):
+        """Write a sequence of (input, result) pairs."""
+        raise NotImplementedError
+
+    def close(self):
+        """Finish and close the output file."""
+        self.file.close()
+
+
+class _JsonSink(_Sink):
+    """Write a single json object mapping each input to its result."""
+
+    def __init__(self, args, source, filtered=False):
+        """Open the output file and start the object."""
+        super(_JsonSink, self).__init__(args, source, filtered)
+        self.file.write(b"{")
+        self.separator = b""
+
+    def write_pairs(self, pairs):
+        """Add results to the object."""
+        # Keys have to be strings, so other inputs are keyed by their json.
+        written = b", ".join(
+            json.dumps(key if isinstance(key, str) else json.dumps(key))
+            .encode("utf-8") + b": " + json.dumps(value).encode("utf-8")
+            for key, value in pairs)
+        if len(written) > 0:
+            self.file.write(self.separator + written)
+            self.separator = b", "
+
+    def close(self):
+        """End the object and close the file."""
+        self.file.write(b"}")
+        super(_JsonSink, self).close()
+
+
+class _JsonLinesSink(_Sink):
+    """Write one [input, result] json array per line."""
+
+    def write_pairs(self, pairs):
+        """Append results to the file."""
+        self.file.write(b"".join(
+            json.dumps([key, value]).encode("utf-8") + b"\n"
+            for key, value in pairs))
+
+
+class _ArraySink(_Sink):
+    """Write results into a numpy .npy array indexed by position.
+
+    For a range of integers the position of each input is input - start.
+
+    The file is laid out in full up front and every block is written in
+    place, so it can be memory-mapped with numpy.load(mmap_mode="r").
+    Results must be numbers; the element type is taken from --dtype, or
+    else starts out as int64 and switches to float64 once a result that
+    isn't an integer arrives.
+    """
+
+    DTYPES = {"int64": ("<i8", "q"), "float64": ("<f8", "d")}
+    # Elements converted at a time when switching to float64.
+    CHUNK = 1 << 20
+    # Written values are read back when switching to float64.
+    mode = "w+b"
+
+    def __init__(self, args, source, filtered=False):
+        """Open the output file."""
+        super(_ArraySink, self).__init__(args, source, filtered)
+        self.start, stop = source.span
+        self.length = stop - self.start
+        self.dtype = args.dtype
+        self.declared = args.dtype is not None
+        self.offset = None
+
+    def write(self, bounds, values):
+        """Store the results of a block in place.
+
+        Raises _SinkError if a result can't be stored in the array.
+        """
+        if self.offset is None:
+            if self.dtype is None:
+                self.dtype = "int64"
+            self.file.write(self._header())
+            self.offset = self.file.tell()
+            self.file.truncate(self.offset + self.length * 8)
+        if self.dtype == "int64" and not all(
+                isinstance(value, numbers.Integral) for value in values):
+            if self.declared:
+                raise _SinkError("Results must be integers to be written "
+                                 "as an int64 array")
+            if all(isinstance(value, numbers.Real) for value in values):
+                self._promote()
+        try:
+            packed = array.array(self.DTYPES[self.dtype][1], values)
+        except TypeError:
+            raise _SinkError(
+                "Results must be numbers to be written as an array")
+        except OverflowError:
+            raise _SinkError(
+                "Results of the block at " + str(bounds) + " don't fit in "
+                + self.dtype + ", write them as json instead")
+        if sys.byteorder != "little":
+            packed.byteswap()
+        self.file.seek(self.offset + (bounds[0] - self.start) * 8)
+        self.file.write(packed.tobytes())
+
+    def _header(self):
+        """Return the .npy header for the array's element type."""
+        header = repr({
+            "descr": self.DTYPES[self.dtype][0], "fortran_order": False,
+            "shape": (self.length,)}).encode("latin1")
+        # The header is padded so that the data starts on a 64 byte boundary.
+        header += b" " * (63 - (len(header) + 10) % 64) + b"\n"
+        return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header
+
+    def _promote(self):
+        """Switch the array to float64, converting what is written so far.
+
+        Both types take 8 bytes and have headers of the same length, so
+        everything is converted in place.
+        """
+        for low in range(0, self.length, self.CHUNK):
+            self.file.seek(self.offset + low * 8)
+            integers = array.array("q")
+            integers.frombytes(
+                self.file.read(min(self.CHUNK, self.length - low) * 8))
+            if sys.byteorder != "little":
+                integers.byteswap()
+            floats = array.array("d", integers)
+            if sys.byteorder != "little":
+                floats.byteswap()
+            self.file.seek(self.offset + low * 8)
+            self.file.write(floats.tobytes())
+        self.dtype = "float64"
+        self.file.seek(0)
+        self.file.write(self._header())
+
+
+SINKS = {"json": _JsonSink, "jsonl": _JsonLinesSink, "npy": _ArraySink}
+
+
+class _ReduceSink(_Sink):
+    """Combine the partial result of each block with the project's reducer.
+
+    Only the running total is kept, and it is written out as json once the
+    run is over.
+    """
+
+    def __init__(self, args, source, reducer):
+        """Open the output file."""
+        super(_ReduceSink, self).__init__(args, source)
+        self.reducer = reducer
+        self.total = None
+        self.empty = True
+
+    def write(self, bounds, values):
+        """Combine the partial result of a block with the total."""
+        # Partials from servers have been through json, so the host's own
+        # are too so that the reducer sees them all the same way.
+        partial = json.loads(json.dumps(values[0]))
+        if self.empty:
+            self.total = partial
+            self.empty = False
+        else:
+            self.total = self.reducer(self.total, partial)
+
+    def close(self):
+        """Write the total and close the file."""
+        self.file.write(json.dumps(self.total).encode("utf-8"))
+        super(_ReduceSink, self).close()
+
 
-    block_id = 0
-    blocks.put((block_id, (low, min(high, args.stop))))
+class _Metrics(object):
+    """Write one json line per event of a run for cerberus stats.
 
-    while high < args.stop:
-        low += block_size
-        high += block_size
-        block_id += 1
-        blocks.put((block_id, (low, min(high, args.stop))))
+    Every record has an "event" name and the "time" it was written. The file
+    is flushed every CHECKPOINT_SECONDS so it can be followed during a run.
+    """
+
+    def __init__(self, path, resume=False):
+        """Start a new file at `path`, or add to it when resuming."""
+        self.file = open(path, "ab" if resume else "wb")
+        self.flushed = time.time()
+
+    def record(self, event, **fields):
+        """Write a record for an event."""
+        fields["event"] = event
+        fields["time"] = time.time()
+        self.file.write(json.dumps(fields).encode("utf-8") + b"\n")
+        if fields["time"] - self.flushed >= CHECKPOINT_SECONDS:
+            self.file.flush()
+            self.flushed = fields["time"]
+
+    def close(self):
+        """Flush and close the file."""
+        self.file.close()
+
+
+class _ResultCache(object):
+    """Remember the results of finished blocks between runs.
+
+    Results are stored per block in an sqlite database, keyed on a hash of
+    the project's target function, the settings it is called with and the
+    contents of every file deployed with it, so any change to the code
+    starts a fresh cache. Entries left by
+    older versions of the project are dropped when it is opened, and the
+    least recently used blocks are evicted once the database holds more than
+    the project's cache_size bytes of results.
+    """
+
+    def __init__(self, controller, data, path=CACHE):
+        """Open the cache for the project described by `data`."""
+        self.controller = controller
+        self.limit = data.get("cache_size", CACHE_SIZE)
+        self.project = (
+            os.path.abspath(data["file"]) + ":" + data["function"])
+        self.target = _target_hash(data)
+        self.synced = time.time()
+        path = os.path.expanduser(path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blocks (target TEXT, project TEXT, "
+            "low INTEGER, high INTEGER, used REAL, payload BLOB, "
+            "PRIMARY KEY (target, low))")
+        self.db.execute(
+            "DELETE FROM blocks WHERE project = ? AND target != ?",
+            (self.project, self.target))
+        self.db.commit()
+
+    def lookup(self, ranges):
+        """Yield (bounds, values) for every cached part of the ranges."""
+        for low, high in ranges:
+            rows = self.db.execute(
+                "SELECT low, high, payload FROM blocks WHERE target = ? "
+                "AND high > ? AND low < ? ORDER BY low",
+                (self.target, low, high))
+            covered = low
+            hits = []
+            for block_low, block_high, payload in rows:
+                start = max(block_low, covered)
+                stop = min(block_high, high)
+                if stop <= start:
+                    continue
+                values = self.controller.decode_values(payload)
+                yield ((start, stop),
+                       values[start - block_low:stop - block_low])
+                covered = stop
+                hits.append(block_low)
+            self.db.executemany(
+                "UPDATE blocks SET used = ? WHERE target = ? AND low = ?",
+                [(time.time(), self.target, hit) for hit in hits])
+        self.db.commit()
+
+    def store(self, bounds, values):
+        """Remember the results of a finished block."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?)",
+            (self.target, self.project, bounds[0], bounds[1], time.time(),
+             sqlite3.Binary(self.controller.encode_values(values))))
+        if time.time() - self.synced >= CHECKPOINT_SECONDS:
+            self.db.commit()
+            self.synced = time.time()
+
+    def close(self):
+        """Evict old blocks if the cache is too big, then close it."""
+        size = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM blocks").fetchone()
+        excess = size[0] - self.limit
+        if excess > 0:
+            evicted = []
+            for rowid, length in self.db.execute(
+                    "SELECT rowid, LENGTH(payload) FROM blocks ORDER BY used"):
+                if excess <= 0:
+                    break
+                evicted.append((rowid,))
+                excess -= length
+            self.db.executemany("DELETE FROM blocks WHERE rowid = ?", evicted)
+        self.db.commit()
+        self.db.close()
+
+
+def _target_hash(data):
+    """Return a hash of the project's target and every deployed file.
+
+    The settings that change how the function is called are included too.
+    """
+    digest = hashlib.sha256()
+    digest.update((data["file"] + ":" + data["function"]).encode("utf-8"))
+    digest.update(json.dumps([
+        data.get("mode", "single"), data.get("setup"), data.get("teardown"),
+        data.get("executor", "process")]).encode("utf-8"))
+    paths = []
+    for name in [data["file"] + ".py"] + sorted(data["files"]):
+        if os.path.isdir(name):
+            paths.extend(sorted(
+                os.path.join(root, filename)
+                for root, _, filenames in os.walk(name)
+                for filename in filenames))
+        else:
+            paths.append(name)
+    digests = _file_digests(paths)
+    for path in paths:
+        digest.update(("\0" + path + "\0" + str(digests[path])).encode(
+            "utf-8"))
+    return digest.hexdigest()
 
-    return blocks, block_id + 1
+
+def _file_digests(paths, cache=DIGESTS):
+    """Return the sha256 of each of the files at `paths`.
+
+    Digests are remembered in `cache` by absolute path along with the
+    file's size, inode and modification and change times, so a file is only
+    read again once it changes, even within the resolution of its
+    modification time. Missing files have a digest of None.
+    """
+    cache = os.path.expanduser(cache)
+    try:
+        with open(cache) as f:
+            known = json.load(f)
+    except (IOError, ValueError):
+        known = {}
+    digests = {}
+    changed = False
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            digests[path] = None
+            continue
+        key = [stat.st_size, stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns]
+        entry = known.get(os.path.abspath(path))
+        if entry is None or entry[:4] != key:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            entry = known[os.path.abspath(path)] = key + [digest.hexdigest()]
+            changed = True
+        digests[path] = entry[4]
+    if changed:
+        # Files that are gone are forgotten, and the cache is replaced in
+        # one step as other runs may be reading it.
+        known = {name: entry for name, entry in known.items()
+                 if os.path.exists(name)}
+        temporary = cache + "." + str(os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cache)):
+                os.makedirs(os.path.dirname(cache))
+            with open(temporary, "w") as f:
+                json.dump(known, f)
+            os.replace(temporary, cache)
+        except OSError:
+            pass
+    return digests
+
+
+class _BlockSource(object):
+    """Lease blocks to workers and take them back from ones that fail.
+
+    Every block handed out is leased to the worker that took it until it is
+    done. Blocks leased to a worker that stops, or that are not done before
+    their lease expires, are handed out again (an expired block to another
+    worker if there is one). Once there is nothing new to
+    hand out, an idle worker is given a copy of the longest running block
+    held by another worker and whichever copy finishes first is kept.
+
+    Subclasses decide how the values are cut into blocks by implementing
+    _next_block.
+    """
+
+    def __init__(self, timeout=0):
+        """Expire leases after `timeout` seconds, or an estimate if 0."""
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.workers = {}
+        self.leases = {}
+        self.retry = collections.deque()
+        self.next_id = 0
+        self.failures = {}
+
+    def register(self, name, cores, calibration=None):
+        """Add a worker that runs `cores` values at a time.
+
+        `calibration` is what cerberus calibrate measured for the worker, if
+        anything. Its cores are used if `cores` is 0.
+        """
+        with self.lock:
+            worker = {"cores": max(cores, 1), "rate": None, "overhead": 0.0,
+                      "reserve": [0, 0]}
+            if calibration is not None:
+                if cores == 0:
+                    worker["cores"] = calibration["cores"]
+                worker["rate"] = calibration["rate"] * worker["cores"]
+                worker["overhead"] = calibration["overhead"]
+            self.workers[name] = worker
+            self.failures.setdefault(name, [])
+
+    def resize(self, name, cores):
+        """Change how many values a worker runs at a time.
+
+        Servers left at 0 cores use every cpu they have, which is only
+        known once their controller has said.
+        """
+        with self.lock:
+            if name in self.workers:
+                self.workers[name]["cores"] = max(cores, 1)
+
+    def take(self, name):
+        """Return the next (block_id, bounds) pair for a worker.
+
+        Returns None if there is no work for it right now. More may turn up
+        later if another worker fails, so check finished() before stopping.
+        """
+        with self.lock:
+            for block_id in list(self.retry):
+                lease = self.leases.get(block_id)
+                # A worker whose lease ran out only gets the block back
+                # once no other worker is left to try it.
+                if lease is not None and name in lease["expired"] and any(
+                        other not in lease["expired"]
+                        for other in self.workers):
+                    continue
+                self.retry.remove(block_id)
+                if lease is not None:
+                    return self._lease(name, block_id)
+
+            bounds = self._next_block(name)
+            if bounds is not None:
+                self.next_id += 1
+                self.leases[self.next_id - 1] = {
+                    "bounds": bounds, "workers": set(), "started": None,
+                    "expired": set()}
+                return self._lease(name, self.next_id - 1)
+
+            # Speculatively run a copy of the longest running block held by
+            # someone else, as long as this worker has nothing else to do.
+            if any(name in lease["workers"] for lease in self.leases.values()):
+                return None
+            candidates = [
+                (lease["started"], block_id)
+                for block_id, lease in self.leases.items()
+                if len(lease["workers"]) == 1 and name not in lease["workers"]]
+            if len(candidates) == 0:
+                return None
+            return self._lease(name, min(candidates)[1])
+
+    def done(self, name, block_id, count, seconds):
+        """Record that a worker took `seconds` to work through a block.
+
+        Returns True if this is the first result for the block, and False if
+        a copy of it has already been finished by another worker.
+        """
+        with self.lock:
+            worker = self.workers.get(name)
+            rate = count / max(seconds, 1e-6)
+            if worker is None:
+                pass
+            elif worker["rate"] is None:
+                worker["rate"] = rate
+            else:
+                worker["rate"] = 0.5 * worker["rate"] + 0.5 * rate
+            return self.leases.pop(block_id, None) is not None
+
+    def release(self, name, reason):
+        """Hand out the blocks leased to a worker that has stopped again."""
+        with self.lock:
+            if name not in self.workers:
+                return
+            returned = 0
+            for block_id, lease in self.leases.items():
+                if name in lease["workers"]:
+                    lease["workers"].discard(name)
+                    if len(lease["workers"]) == 0:
+                        self.retry.append(block_id)
+                        returned += 1
+            self._forget(name)
+            del self.workers[name]
+            self.failures[name].append(
+                reason + " (" + str(returned) + " blocks handed out again)")
+
+    def expire(self):
+        """Hand out again every block whose lease has run out."""
+        now = time.time()
+        with self.lock:
+            for block_id, lease in self.leases.items():
+                if lease["deadline"] is not None and now > lease["deadline"]:
+                    lease["deadline"] = None
+                    self.retry.append(block_id)
+                    lease["expired"].update(lease["workers"])
+                    for name in lease["workers"]:
+                        self.failures[name].append(
+                            "block " + str(lease["bounds"]) + " timed out")
+
+    def finished(self):
+        """Return True once every block has been done."""
+        with self.lock:
+            return len(self.leases) == 0 and self._exhausted()
+
+    def report(self):
+        """Return a list of the problems seen with each worker."""
+        with self.lock:
+            return dict(self.failures)
+
+    def _lease(self, name, block_id):
+        """Lease a block to a worker and return its (block_id, bounds)."""
+        lease = self.leases[block_id]
+        now = time.time()
+        lease["workers"].add(name)
+        if lease["started"] is None:
+            lease["started"] = now
+        bounds = lease["bounds"]
+        lease["deadline"] = now + self._lease_time(name, bounds)
+        return block_id, bounds
+
+    def _lease_time(self, name, bounds):
+        """Return how long a worker may take on a block before it expires."""
+        if self.timeout > 0:
+            return self.timeout
+        rate = self.workers[name]["rate"]
+        if rate is None:
+            return LEASE_MINIMUM
+        expected = (bounds[1] - bounds[0]) / rate
+        return max(LEASE_MINIMUM, LEASE_FACTOR * expected)
+
+    def _next_block(self, name):
+        """Return the bounds of a new block for a worker, or None."""
+        raise NotImplementedError
+
+    def _forget(self, name):
+        """Give back anything set aside for a worker that has stopped."""
+
+    def _exhausted(self):
+        """Return True once _next_block has nothing left to hand out."""
+        raise NotImplementedError
+
+
+class _BlockCursor(_BlockSource):
+    """Hand out blocks of a fixed size on demand.
+
+    Blocks are numbered in order and their bounds are worked out from the
+    number of the next one to hand out, so the cost of a run does not
+    depend on how many blocks it is split into.
+    """
+
+    def __init__(self, ranges, block_size, timeout=0):
+        """Split each (low, high) range into blocks of block_size values."""
+        super(_BlockCursor, self).__init__(timeout)
+        self.ranges = list(ranges)
+        self.block_size = block_size
+        # The number of blocks before each range, and in total.
+        self.offsets = []
+        self.total_blocks = 0
+        for low, high in self.ranges:
+            self.offsets.append(self.total_blocks)
+            self.total_blocks += -(-(high - low) // block_size)
+        self.next_block = 0
+
+    def _next_block(self, name):
+        """Return the bounds of the next block in order."""
+        if self._exhausted():
+            return None
+        index = bisect.bisect_right(self.offsets, self.next_block) - 1
+        low, high = self.ranges[index]
+        low += (self.next_block - self.offsets[index]) * self.block_size
+        self.next_block += 1
+        return low, min(low + self.block_size, high)
+
+    def _exhausted(self):
+        """Return True once every block has been handed out."""
+        return self.next_block >= self.total_blocks
+
+
+class _Scheduler(_BlockSource):
+    """Hand out blocks sized to the worker asking for them.
+
+    Each worker reserves a share of the outstanding values in proportion to
+    its measured throughput (or its core count until that is known) and is
+    given blocks of about BLOCK_SECONDS of work from its reservation.
+    Reservations are guided: they shrink as fewer values are left, and a
+    worker that runs dry once everything is reserved takes over part of the
+    largest reservation left. That way every worker finishes at about the
+    same time.
+    """
+
+    def __init__(self, ranges, timeout=0):
+        """Schedule every value in the given list of (low, high) ranges."""
+        super(_Scheduler, self).__init__(timeout)
+        self.ranges = collections.deque(
+            (low, high) for low, high in ranges if high > low)
+        self.unreserved = sum(high - low for low, high in self.ranges)
+
+    def _next_block(self, name):
+        """Cut a block for a worker from its reservation."""
+        worker = self.workers[name]
+        reserve = worker["reserve"]
+        if reserve[1] - reserve[0] == 0 and not self._refill(name):
+            return None
+
+        size = min(self._block_size(name), reserve[1] - reserve[0])
+        if reserve[1] - reserve[0] - size < worker["cores"]:
+            # Don't leave a tail too small to keep the worker busy.
+            size = reserve[1] - reserve[0]
+        reserve[0] += size
+        return reserve[0] - size, reserve[0]
+
+    def _exhausted(self):
+        """Return True once every value has been put in a block."""
+        return self.unreserved == 0 and all(
+            w["reserve"][1] == w["reserve"][0] for w in self.workers.values())
+
+    def _forget(self, name):
+        """Put the rest of a stopped worker's reservation back."""
+        low, high = self.workers[name]["reserve"]
+        if high > low:
+            self.ranges.appendleft((low, high))
+            self.unreserved += high - low
+
+    def _weight(self, name):
+        """Return the throughput expected of a worker."""
+        worker = self.workers[name]
+        if worker["rate"] is not None:
+            return worker["rate"]
+        measured = [w for w in self.workers.values() if w["rate"] is not None]
+        if len(measured) == 0:
+            return float(worker["cores"])
+        per_core = (sum(w["rate"] for w in measured)
+                    / sum(w["cores"] for w in measured))
+        return per_core * worker["cores"]
+
+    def _share(self, name):
+        """Return the fraction of the total throughput a worker provides."""
+        total = sum(self._weight(other) for other in self.workers)
+        return self._weight(name) / total
+
+    def _block_size(self, name):
+        """Return how many values to put in the next block for a worker."""
+        worker = self.workers[name]
+        if worker["rate"] is None:
+            size = worker["cores"] * PROBE_SIZE
+        else:
+            seconds = max(BLOCK_SECONDS, OVERHEAD_FACTOR * worker["overhead"])
+            size = int(worker["rate"] * seconds)
+        left = self.unreserved + sum(
+            w["reserve"][1] - w["reserve"][0] for w in self.workers.values())
+        guided = int(left * self._share(name) / GUIDED)
+        return max(min(size, guided), worker["cores"], 1)
+
+    def _refill(self, name):
+        """Give a worker a new reservation, returning False if none is left.
+        """
+        reserve = self.workers[name]["reserve"]
+        if self.unreserved > 0:
+            low, high = self.ranges.popleft()
+            size = int(self.unreserved * self._share(name) / GUIDED)
+            size = min(max(size, self._block_size(name)), high - low)
+            if low + size < high:
+                self.ranges.appendleft((low + size, high))
+            self.unreserved -= size
+            reserve[:] = [low, low + size]
+            return True
+
+        # Everything is reserved, so take over the end of the largest
+        # reservation held by another worker.
+        victim = max(
+            (other for other in self.workers if other != name),
+            key=lambda other: (self.workers[other]["reserve"][1]
+                               - self.workers[other]["reserve"][0]),
+            default=None)
+        if victim is None:
+            return False
+        low, high = self.workers[victim]["reserve"]
+        if high == low:
+            return False
+        if high - low < 2 * self.workers[name]["cores"]:
+            # Too little to split, so take all of it rather than leave it
+            # with a worker that may be stuck.
+            split = low
+        else:
+            weight = self._weight(name)
+            split = high - int((high - low) * weight
+                               / (weight + self._weight(victim)))
+            split = min(max(split, low + 1), high - 1)
+        self.workers[victim]["reserve"][1] = split
+        reserve[:] = [split, high]
+        return True
 
 
 def _remove_server(server, data):
     """Remove files from a particular server."""
-    rm_args = [
-        "ssh",
-        server["user"] + "@" + str(server["location"]),
-        "rm", "-rf", ".cerberus/" + data["name"]]
-    print("Deleting files from "
-          + server["user"] + "@" + str(server["location"]) + " ", end="")
+    transport = _transport(server, data)
+    print("Deleting files from " + transport.describe() + " ", end="")
     sys.stdout.flush()
-    proc = subprocess.Popen(
-        rm_args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    proc.wait()
-    if proc.returncode != 0:
+    code, _, err = transport.call(
+        ["rm", "-rf", ".cerberus/" + data["name"]])
+    if code != 0:
         print("Error")
-        print(proc.stderr.readline().strip())
+        print((err.strip().splitlines() or [""])[0])
     else:
         print(" ...Done")
 
 
+def _deploy(servers, data, jobs=1):
+    """Upload the project files to several servers at once.
+
+    At most `jobs` transfers run at the same time. A summary with one line
+    per server is printed once every transfer has finished.
+    """
+    if len(servers) == 0:
+        print("No servers to update")
+        return []
+
+    print("Uploading to " + str(len(servers)) + " server(s)...")
+    sys.stdout.flush()
+    pool = multiprocessing.pool.ThreadPool(max(1, min(jobs, len(servers))))
+    try:
+        outcomes = pool.map(lambda server: _upload_to(server, data), servers)
+    finally:
+        pool.close()
+        pool.join()
+
+    width = max(len(server["name"]) for server in servers)
+    failed = 0
+    for server, error, elapsed in outcomes:
+        status = "ok" if error is None else "error: " + error
+        if error is not None:
+            failed += 1
+        print("  " + server["name"].ljust(width), "{:6.1f}s".format(elapsed),
+              status)
+    print(str(len(servers) - failed), "of", str(len(servers)),
+          "server(s) updated")
+    return outcomes
+
+
 def _upload_to(remote, data):
-    """Upload project files to a single server."""
-    _ensure_dir(".cerberus", remote)
-    _ensure_dir(".cerberus/" + data["name"], remote)
+    """Upload project files to a single server in one transfer.
+
+    Returns a tuple of the server, an error message or None, and the number
+    of seconds the transfer took.
+    """
+    start = time.time()
+    try:
+        message = _transport(remote, data).upload()
+    except (IOError, OSError) as error:
+        message = str(error)
+    return remote, message, time.time() - start
+
 
-    program_name = data["file"] + ".py"
-    _upload_file(program_name, remote, data["name"])
-    for filename in data["files"]:
-        _upload_file(filename, remote, data["name"])
+def _upload_args(remote, data):
+    """Build the rsync command that pushes every project file to a server.
 
-    if data["local"]:
-        _upload_file("controller.py", remote, data["name"])
+    The remote project directory is created by the same connection through
+    --rsync-path so no separate ssh call is needed.
+    """
+    target = ".cerberus/" + data["name"]
+    ssh_args = _ssh_command(remote, _ssh_persist(data))
+    return [
+        "rsync", "-rc", "-e", " ".join(
+            shlex.quote(arg) for arg in ssh_args[:-1]),
+        "--rsync-path=mkdir -p " + target + " && rsync"] + [
+            os.path.expanduser(name) for name in _deploy_files(data)] + [
+                ssh_args[-1] + ":" + target + "/"]
+
+
+def _deploy_files(data):
+    """Return the list of files that make up a deployment of the project."""
+    files = [data["file"] + ".py"] + list(data["files"])
+    if data.get("local"):
+        files.append("controller.py")
     else:
-        _upload_file("~/.cerberus/controller.py", remote, data["name"])
+        files.append("~/.cerberus/controller.py")
+    return files
 
 
-def _upload_file(file, remote, name):
-    """Upload a single file to a server."""
-    rsync_args = [
-        "rsync", "-rc", os.path.expanduser(file),
-        remote["user"] + "@" + remote["location"]
-        + ":~/.cerberus/" + name + "/"]
-    print("Uploading " + file + " ", end="")
-    sys.stdout.flush()
-    proc = subprocess.Popen(
-        rsync_args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    proc.wait()
-    if proc.returncode != 0:
-        print("Error")
-        print(proc.stderr.readline().strip())
-    else:
-        print(" ...Done")
+class _SshTransport(object):
+    """Reach a server over ssh.
+
+    Commands run in the user's home directory on the server, and all of them
+    share one master connection. Files are uploaded with rsync over the same
+    connection.
+    """
 
+    # The python that runs the controller on the server.
+    python = "python"
+
+    def __init__(self, server, data):
+        """Reach the given server of a project."""
+        self.server = server
+        self.data = data
+
+    def describe(self):
+        """Return how the server is shown to the user."""
+        if self.server["name"] == self.server["location"]:
+            return self.server["user"] + "@" + self.server["location"]
+        return (self.server["user"] + "@" + self.server["name"] + " ("
+                + self.server["location"] + ")")
+
+    def start(self, command):
+        """Start a command with pipes to its stdin and stdout."""
+        return subprocess.Popen(
+            self._ssh() + command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    async def start_async(self, command):
+        """Start a command as an asyncio subprocess with pipes."""
+        return await asyncio.create_subprocess_exec(
+            *(self._ssh() + command), stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, limit=LINE_LIMIT)
+
+    def call(self, command):
+        """Run a command and return its exit code, stdout and stderr."""
+        proc = subprocess.Popen(
+            self._ssh() + command, stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE, universal_newlines=True)
+        out, err = proc.communicate()
+        return proc.returncode, out, err
 
-def _ensure_dir(name, remote):
-    """Ensure that the specified directory is present on the server.
+    def upload(self):
+        """Copy the project's files in one transfer.
 
-    If it is not present it is then created.
+        Returns an error message, or None if the upload worked.
+        """
+        proc = subprocess.Popen(
+            _upload_args(self.server, self.data), stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE, universal_newlines=True)
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            lines = err.strip().splitlines()
+            if len(lines) == 0:
+                lines = ["exit code " + str(proc.returncode)]
+            return lines[-1]
+        return None
+
+    def close(self):
+        """Shut down the shared connection if one is open."""
+        _close_session(self.server)
+
+    def _ssh(self):
+        """Return the ssh command that runs a command on the server."""
+        return _ssh_command(self.server, _ssh_persist(self.data))
+
+
+class _LocalTransport(object):
+    """Run a worker as a process on this machine in a directory of its own.
+
+    The directory takes the place of the home directory on a server, so
+    workers are deployed, run and cleaned up just like servers but without
+    ssh.
     """
-    ssh_args = [
-        "ssh", remote["user"] + "@" + str(remote["location"]), "mkdir", name]
-    proc = subprocess.Popen(
-        ssh_args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    proc.wait()
-    err = proc.stderr.readline().strip()
-    if not err.endswith("File exists"):
-        sys.exit(err)
+
+    # The python that runs the controller, which is the one running this.
+    python = sys.executable
+
+    def __init__(self, server, data):
+        """Reach the given worker of a project."""
+        self.server = server
+        self.data = data
+        self.home = os.path.expanduser(server["location"])
+
+    def describe(self):
+        """Return how the worker is shown to the user."""
+        return (self.server["name"] + " (local worker in "
+                + self.server["location"] + ")")
+
+    def start(self, command):
+        """Start a command with pipes to its stdin and stdout."""
+        if not os.path.isdir(self.home):
+            os.makedirs(self.home)
+        return subprocess.Popen(
+            command, cwd=self.home, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    async def start_async(self, command):
+        """Start a command as an asyncio subprocess with pipes."""
+        if not os.path.isdir(self.home):
+            os.makedirs(self.home)
+        return await asyncio.create_subprocess_exec(
+            *command, cwd=self.home, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, limit=LINE_LIMIT)
+
+    def call(self, command):
+        """Run a command and return its exit code, stdout and stderr."""
+        if not os.path.isdir(self.home):
+            # Nothing has been deployed so there is nothing to act on.
+            return 0, "", ""
+        proc = subprocess.Popen(
+            command, cwd=self.home, stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE, universal_newlines=True)
+        out, err = proc.communicate()
+        return proc.returncode, out, err
+
+    def upload(self):
+        """Copy the project's files into the worker's directory.
+
+        Returns None, as errors are raised as OSError.
+        """
+        target = os.path.join(self.home, ".cerberus", self.data["name"])
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in _deploy_files(self.data):
+            path = os.path.expanduser(name).rstrip("/")
+            if os.path.isdir(path):
+                copy = os.path.join(target, os.path.basename(path))
+                if os.path.isdir(copy):
+                    shutil.rmtree(copy)
+                shutil.copytree(path, copy)
+            else:
+                shutil.copy2(path, target)
+        return None
+
+    def close(self):
+        """Do nothing, as there is no connection to close."""
+
+
+TRANSPORTS = {"ssh": _SshTransport, "local": _LocalTransport}
+
+
+def _transport(server, data):
+    """Return the transport that reaches a server of a project."""
+    return TRANSPORTS[server.get("transport", "ssh")](server, data)
+
+
+def _ssh_persist(data):
+    """Return how long the project keeps idle ssh connections open."""
+    return data.get("ssh_persist", SSH_PERSIST)
+
+
+def _ssh_command(server, persist=SSH_PERSIST):
+    """Return the ssh command that runs a command on a server.
+
+    Every call for the same server shares one master connection, so only
+    the first pays for the ssh handshake. The master stays open for
+    `persist` seconds after it was last used so that back-to-back
+    invocations of cerberus can reuse it as well.
+    """
+    control_dir = os.path.expanduser("~/.cerberus/ssh")
+    if not os.path.isdir(control_dir):
+        os.makedirs(control_dir, 0o700)
+    destination = server["user"] + "@" + str(server["location"])
+    _ssh_sessions[destination] = persist
+    return [
+        "ssh", "-o", "ControlMaster=auto",
+        "-o", "ControlPath=" + os.path.join(control_dir, "%C"),
+        "-o", "ControlPersist=" + str(max(persist, 1)),
+        destination]
+
+
+def _close_session(server):
+    """Shut down the master connection to a server if one is open."""
+    ssh_args = _ssh_command(server)
+    destination = ssh_args.pop()
+    del _ssh_sessions[destination]
+    with open(os.devnull, "w") as devnull:
+        subprocess.call(
+            ssh_args + ["-O", "exit", destination],
+            stdout=devnull, stderr=devnull)
+
+
+def _close_sessions():
+    """Close the master connections that should not outlive this process."""
+    for destination, persist in list(_ssh_sessions.items()):
+        if persist == 0:
+            user, location = destination.split("@", 1)
+            _close_session({"user": user, "location": location})
+
+
+atexit.register(_close_sessions)
 
 
 def create_parser():
@@ -313,13 +2281,18 @@ def create_parser():
 
     new_args(subparser)
     add_remote_args(subparser)
+    add_worker_args(subparser)
     add_file_args(subparser)
     list_args(subparser)
     clean_args(subparser)
     remove_remote_args(subparser)
     remove_file_args(subparser)
     update_args(subparser)
+    calibrate_args(subparser)
+    agent_args(subparser)
     run_args(subparser)
+    stats_args(subparser)
+    disconnect_args(subparser)
     return parser
 
 
@@ -353,6 +2326,53 @@ def new_args(subparser):
         "--use-local-controller", dest="local", action="store_true",
         help="""Use a controller.py found in the directory of this project.
                 Otherwise it uses the one at ~/.Cerberus/controller.py""")
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="""Call the function with a start and stop value for a whole
+        chunk of values at once instead of once for each value. It must
+        return a sequence of the results for range(start, stop).""")
+    parser.add_argument(
+        "--setup", metavar="FUNCTION",
+        help="""A function in the same file that is called once in each
+        worker process before any values are run. Whatever it returns is
+        passed to the function as an extra last argument.""")
+    parser.add_argument(
+        "--teardown", metavar="FUNCTION",
+        help="""A function in the same file that is called when each worker
+        process finishes, with the result of --setup if there is one.""")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--reduce", metavar="FUNCTION",
+        help="""A function in the same file that combines two results into
+        one, such as a sum or a max. Results are combined on the servers as
+        they are computed and the output is the result for the whole run.
+        It must give the same answer whatever order results are combined
+        in.""")
+    group.add_argument(
+        "--filter", action="store_true",
+        help="""Only keep the inputs whose result is not None. The others are
+        dropped on the servers instead of being sent back.""")
+    parser.add_argument(
+        "--executor", choices=EXECUTORS, default="process",
+        help="""What runs the function: a pool of processes, one per core
+        (process), a pool of threads in one process for functions that wait
+        on i/o or release the GIL (thread) or an event loop for async def
+        functions (async). Defaults to process.""")
+    parser.add_argument(
+        "--concurrency", type=int, default=0,
+        help="""How many calls run at once on each server. Defaults to one
+        per core for processes, 16 per core for threads and 64 per core for
+        async.""")
+    parser.add_argument(
+        "--cache-size", type=int, default=CACHE_SIZE >> 20,
+        help="""How many megabytes of results to remember between runs so
+        that values that have already been computed are not run again.
+        Defaults to """ + str(CACHE_SIZE >> 20) + ".")
+    parser.add_argument(
+        "--ssh-persist", type=int, default=SSH_PERSIST,
+        help="""How many seconds to keep idle ssh connections to servers open
+        so that later commands can reuse them. 0 closes them as soon as each
+        command finishes. Defaults to """ + str(SSH_PERSIST) + ".")
 
 
 def add_remote_args(subparser):
@@ -371,9 +2391,62 @@ def add_remote_args(subparser):
         "-c", "--cores", type=int, default=0,
         help="""Specifies how many threads to run.
         Defaults to the number of cpu cores.""")
+    parser.add_argument(
+        "-w", "--window", type=int, default=0,
+        help="""How many blocks to send to this server at once so that it has
+        work queued while results travel back. Defaults to """ + str(WINDOW)
+        + ".")
     parser.add_argument(
         "-u", "--upload", action="store_true",
         help="Upload files to server immediately")
+    parser.add_argument(
+        "--executor", choices=EXECUTORS, default=None,
+        help="Overrides the project's executor on this server.")
+    parser.add_argument(
+        "--concurrency", type=int, default=None,
+        help="Overrides the project's concurrency on this server.")
+    parser.add_argument(
+        "--prefix",
+        help="""A command to start the controller with on the server, eg.
+        'nice -n 10'.""")
+
+
+def add_worker_args(subparser):
+    """Add the subparser for the add-worker command."""
+    parser = subparser.add_parser(
+        "add-worker",
+        help="""Adds a worker that runs on this machine in a directory of its
+        own, with its own pool of processes, and is used just like a remote
+        server.  Useful for splitting a large machine up (for example one
+        worker per NUMA node with --prefix 'numactl --cpunodebind=N
+        --membind=N') or for testing without ssh.""")
+    parser.set_defaults(func=add_worker)
+    parser.add_argument("name", help="The name of the worker")
+    parser.add_argument(
+        "-d", "--directory",
+        help="""The directory the worker runs in. Defaults to """ + WORKERS
+        + "/name.")
+    parser.add_argument(
+        "-c", "--cores", type=int, default=0,
+        help="""Specifies how many threads to run.
+        Defaults to the number of cpu cores.""")
+    parser.add_argument(
+        "-w", "--window", type=int, default=0,
+        help="""How many blocks to send to this worker at once. Defaults to
+        """ + str(WINDOW) + ".")
+    parser.add_argument(
+        "-u", "--upload", action="store_true",
+        help="Upload files to the worker immediately")
+    parser.add_argument(
+        "--executor", choices=EXECUTORS, default=None,
+        help="Overrides the project's executor on this worker.")
+    parser.add_argument(
+        "--concurrency", type=int, default=None,
+        help="Overrides the project's concurrency on this worker.")
+    parser.add_argument(
+        "--prefix",
+        help="""A command to start the controller with, eg. 'numactl
+        --cpunodebind=0 --membind=0'.""")
 
 
 def add_file_args(subparser):
@@ -383,6 +2456,13 @@ def add_file_args(subparser):
     parser.set_defaults(func=add_file)
     parser.add_argument(
         "file", nargs="+", help="file(s) to be added to the project")
+    parser.add_argument(
+        "--shared", action="store_true",
+        help="""The files are large read-only data that every worker uses.
+        Each one is mapped into memory once per machine and passed to the
+        setup function, or to the function if there is no setup, in a dict
+        by file name. Servers whose copies differ from this machine's are
+        not used until they are updated.""")
 
 
 def list_args(subparser):
@@ -432,6 +2512,72 @@ def update_args(subparser):
         "update",
         help="""Deploys code and data files to all remote servers""")
     parser.set_defaults(func=update_remote)
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=8,
+        help="""The number of servers to upload to at the same time.
+        Defaults to 8.""")
+
+
+def disconnect_args(subparser):
+    """Add the subparser for the disconnect command."""
+    parser = subparser.add_parser(
+        "disconnect",
+        help="""Closes any open ssh connections to the project's servers""")
+    parser.set_defaults(func=disconnect)
+
+
+def agent_args(subparser):
+    """Add the subparser for the agent command."""
+    parser = subparser.add_parser(
+        "agent",
+        help="""Starts, stops or shows the status of an agent on every
+        server that keeps the project loaded with a warm pool of processes
+        between runs, so short runs don't pay for starting up.  Runs use the
+        agents while they are started.  Run cerberus update first, as the
+        agent is started from the deployed files.""")
+    parser.set_defaults(func=agent)
+    parser.add_argument("action", choices=["start", "stop", "status"])
+    parser.add_argument(
+        "-p", "--port", type=int, default=AGENT_PORT,
+        help="""The local port the agents listen on. Defaults to """
+        + str(AGENT_PORT) + ".")
+
+
+def calibrate_args(subparser):
+    """Add the subparser for the calibrate command."""
+    parser = subparser.add_parser(
+        "calibrate",
+        help="""Measures how fast the project runs on each machine so that
+        runs can share out work between them from the start.  Run it again
+        after changing the project's files.""")
+    parser.set_defaults(func=calibrate)
+    parser.add_argument(
+        "-s", "--start", action="store", default=0, type=int,
+        help="""The first value to run the function on while measuring.
+        Defaults to 0.""")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "-l", "--local-only", action="store_true",
+        help="Only measure the host")
+    group.add_argument(
+        "-r", "--remote-only", action="store_true",
+        help="Only measure the servers")
+
+
+def stats_args(subparser):
+    """Add the subparser for the stats command."""
+    parser = subparser.add_parser(
+        "stats",
+        help="""Shows where the time went in the last run, for each worker
+        and in total, and which workers finished late.""")
+    parser.set_defaults(func=stats)
+    parser.add_argument(
+        "output", nargs="?",
+        help="""The output file of the run to summarize. Defaults to the run
+        whose metrics in this directory were written last.""")
+    parser.add_argument(
+        "--metrics",
+        help="The metrics file written by the run, instead of its output.")
 
 
 def run_args(subparser):
@@ -444,14 +2590,77 @@ def run_args(subparser):
         Defaults to 0. (inclusive)""")
 
     parser.add_argument(
-        "stop", type=int,
-        help="Specifies the value to increment to (exclusive)")
+        "stop", type=int, nargs="?",
+        help="""Specifies the value to increment to (exclusive). Needed unless
+        --input or --grid is given.""")
+    parser.add_argument(
+        "output", help="Specifies a file to put the output into")
+    parser.add_argument(
+        "--step", type=int, default=1,
+        help="Only run every step-th value from start. Defaults to 1.")
     parser.add_argument(
-        "output", help="Specifies a file to put the output into in json form")
+        "--input", default=None,
+        help="""Run on the values in this file instead of a range, one per
+        line. Lines are read as json, or as strings if they aren't json.""")
+    parser.add_argument(
+        "--grid", action="append", default=[], metavar="AXIS",
+        help="""Run on every combination of the values of the axes given
+        with this option instead of a range. An axis is
+        [name=]start:stop[:step] or [name=]value,value,... and if every axis
+        is named each input is a dict from names to values, otherwise a
+        list.""")
+    parser.add_argument(
+        "-f", "--format", choices=sorted(SINKS), default=None,
+        help="""The format of the output file: a single json object (json),
+        one [input, result] pair per line (jsonl) or a numpy array of numeric
+        results in the order of their inputs (npy). Defaults to the output
+        file's extension, or json.""")
+    parser.add_argument(
+        "--dtype", choices=sorted(_ArraySink.DTYPES), default=None,
+        help="""The element type of npy output. Defaults to int64 while the
+        results are all integers and float64 once any of them isn't.""")
     parser.add_argument(
         "-b", "--block-size", action="store", default=0, type=int,
-        help="""Specifies how large to make the blocks. If left out block size
-        will be determined by the number of values to be calculated.""")
+        help="""Specifies how large to make the blocks. If left out each block
+        is sized to the speed of the machine it is sent to.""")
+    parser.add_argument(
+        "-w", "--window", type=int, default=None,
+        help="""How many blocks to send to each server at once. Overrides the
+        window set for individual servers.""")
+    parser.add_argument(
+        "-z", "--compress", action="store_true",
+        help="""Compress results sent back from servers. Useful when the
+        network rather than the servers is the bottleneck.""")
+    parser.add_argument(
+        "-t", "--timeout", type=float, default=0,
+        help="""Seconds a server may spend on a block before it is handed to
+        another server. Defaults to ten times the time the block is expected
+        to take, and at least a minute.""")
+    parser.add_argument(
+        "--priority", type=float, default=1,
+        help="""How large a share of each server's cores this run gets when
+        other runs are using the server's agent at the same time, relative to
+        their priorities. Defaults to 1.""")
+    parser.add_argument(
+        "--metrics",
+        help="""Where to write the timings of every block as json lines,
+        for cerberus stats. Defaults to the output file's name followed by
+        """ + METRICS + ".")
+    parser.add_argument(
+        "--profile", nargs="?", const=PROFILES, default=None, metavar="DIR",
+        help="""Sample where every process of the run spends its cpu time,
+        on the host and on every server, and show the functions that take
+        the most. The samples for each server and for the whole run are
+        written to DIR in the folded format that flame graph tools read.
+        DIR defaults to """ + PROFILES + ".")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="""Compute every value even if it has been computed before, and
+        don't remember the results.""")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="""Continue an interrupted run from where it stopped instead of
+        starting over. The other arguments must match the original run.""")
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         "-l", "--local-only", action="store_true",
@@ -461,74 +2670,607 @@ def run_args(subparser):
         help="Only run the program remotely")
 
 
-def remote_runner(server, blocks, results_queue, data, end_event):
+async def remote_runner(server, coordinator, data, args, source,
+                        calibration=None):
     """Connect to a remote server and run the project on it."""
-    remote_cmds = [
-        "python", ".cerberus/" + data["name"] + "/controller.py",
-        str(server["cores"]), data["file"], data["function"]]
+    name = server["name"]
+    blocks = coordinator.blocks
+    stop = coordinator.stop
+    blocks.register(name, server["cores"], calibration)
+    proc = await _transport(server, data).start_async(
+        _controller_command(server, data))
+    conn = _AsyncConnection(proc, _load_controller(data))
+    in_flight = collections.deque()
+    try:
+        options = dict(_options(data, server), priority=args.priority,
+                       profile=args.profile is not None)
+        if await _until(stop, conn.negotiate(args.compress, options)) is None:
+            return
+        if not server["cores"] and calibration is None and conn.cpus:
+            blocks.resize(name, conn.cpus)
+        if source.shipped((0, 0)) is not None and not conn.values:
+            blocks.release(name, "its controller is too old for --input, "
+                           "--grid and --step, run cerberus update")
+            return
+        if (data.get("reduce") or data.get("filter")) and not conn.reduce:
+            blocks.release(name, "its controller is too old to reduce or "
+                           "filter results, run cerberus update")
+            return
+        if len(options["shared"]) > 0 and conn.stale is None:
+            blocks.release(name, "its controller is too old for shared "
+                           "data, run cerberus update")
+            return
+        if conn.stale:
+            blocks.release(name, "its copy of " + ", ".join(conn.stale)
+                           + " differs from this machine's, run cerberus "
+                           "update")
+            return
+        if options["executor"] not in conn.executors:
+            blocks.release(name, "its controller can't use the "
+                           + options["executor"] + " executor")
+            return
+        coordinator.log("connected to " + name + " (" + conn.protocol + ")")
+        window = _window(server, args)
+        last_result = time.time()
+        while not stop.is_set():
+            # Keep the server's queue topped up so that it never waits on
+            # the network between blocks.
+            while len(in_flight) < window:
+                block = blocks.take(name)
+                if block is None:
+                    break
+                conn.send_block(block[1], source.shipped(block[1]))
+                in_flight.append(block + (time.time(),))
+            await conn.flush()
+            if len(in_flight) == 0:
+                # More work can turn up if another worker fails.
+                if blocks.finished():
+                    break
+                await _pause(stop, POLL_TIMEOUT)
+                continue
+
+            values = await _until(stop, conn.read_result())
+            if values is None:
+                break
+            block_id, bounds, sent = in_flight.popleft()
+
+            # the server started on this block once it had been sent and
+            # the previous one was finished
+            now = time.time()
+            first = blocks.done(name, block_id, bounds[1] - bounds[0],
+                                now - max(sent, last_result))
+            last_result = now
+
+            # whatever the round trip took beyond the controller's own work
+            # was spent on the network
+            timings = dict(conn.timings, worker=name)
+            timings["network"] = max(now - sent - sum(
+                timings.get(key, 0.0)
+                for key in ("queue", "compute", "encode", "decode")), 0.0)
+
+            # keep the result unless a copy of the block sent to another
+            # worker beat it
+            coordinator.save(
+                block_id, bounds, values if first else None, timings)
+    except (EOFError, OSError):
+        blocks.release(name, "lost connection")
+    finally:
+        try:
+            conn.close()
+        except (IOError, OSError):
+            pass
+        if args.profile is not None and conn.profiled:
+            try:
+                samples = await asyncio.wait_for(
+                    conn.read_profile(), PROFILE_WAIT)
+                coordinator.profiles[name] = samples
+            except (asyncio.TimeoutError, EOFError, OSError, ValueError,
+                    _FunctionError):
+                coordinator.log("no profile from " + name)
+        try:
+            # Controllers give up on the blocks still running once the
+            # session is closed, but older ones carry on with them.
+            await asyncio.wait_for(conn.wait_closed(), CONTROLLER_WAIT)
+        except asyncio.TimeoutError:
+            if proc.returncode is None:
+                proc.terminate()
+            await proc.wait()
 
-    ssh_cmds = [
-        "ssh", server["user"] + "@" + server["location"]]
 
-    try:
-        print(ssh_cmds + remote_cmds)
-        proc = subprocess.Popen(
-            ssh_cmds + remote_cmds, stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print("connected to " + server["name"])
+def _start_controller(server, data):
+    """Start the project's controller on a server."""
+    return _transport(server, data).start(_controller_command(server, data))
 
-        try:
-            while not end_event.is_set():
-                block_id, bounds = blocks.get(False)   # block_id
-                data = {"start": bounds[0], "stop": bounds[1]}
 
-                # send data as json
-                print(json.dumps(data), file=proc.stdin)
+def _controller_command(server, data):
+    """Return the command that starts the project's controller on a server.
+
+    If an agent has been started on the server the controller hands the
+    session over to it.
+    """
+    transport = _transport(server, data)
+    command = shlex.split(server.get("prefix", "")) + [
+        transport.python, ".cerberus/" + data["name"] + "/controller.py"]
+    if "agent" in server:
+        command += ["--connect", str(server["agent"])]
+    return command + [str(server["cores"]), data["file"], data["function"]]
 
-                out_string = ""
-                while not out_string.endswith("$"):
-                    partial = proc.stdout.readline()
-                    out_string += partial.strip()
-                    time.sleep(0.5)
 
-                # receive result as json
-                result = json.loads(out_string.strip("$"))
+def _options(data, server=None):
+    """Return the project settings that are sent to a controller.
 
-                # add result to result queue
-                results_queue.put((block_id, result["solution"]))
+    A server can override the executor and concurrency. Shared data files
+    are given by name with their sha256 so that the controller can check
+    its copies.
+    """
+    shared = data.get("shared", [])
+    digests = _file_digests(shared) if len(shared) > 0 else {}
+    options = {
+        "mode": data.get("mode", "single"),
+        "setup": data.get("setup"),
+        "teardown": data.get("teardown"),
+        "reduce": data.get("reduce"),
+        "filter": data.get("filter", False),
+        "executor": data.get("executor", "process"),
+        "concurrency": data.get("concurrency", 0),
+        "shared": {os.path.basename(path): digests[path] for path in shared}}
+    for name in ("executor", "concurrency"):
+        if server is not None and name in server:
+            options[name] = server[name]
+    return options
+
+
+def _local_options(data):
+    """Return the project settings for running on the host.
+
+    Shared data is read from where it was added from.
+    """
+    return dict(_options(data), paths={
+        os.path.basename(path): path for path in data.get("shared", [])})
 
-                # call task_done when we are finished
-                blocks.task_done()
-        except queue.Empty:
+
+def _window(server, args):
+    """Return how many blocks to keep in flight on a server."""
+    if args.window is not None:
+        return max(args.window, 1)
+    return max(server.get("window", 0), 0) or WINDOW
+
+
+class _Session(object):
+    """The host's side of the protocol spoken with a controller.
+
+    The session starts out speaking newline delimited json and switches to
+    the controller's binary protocol if both ends support it. Subclasses
+    move the messages over a pipe.
+    """
+
+    def __init__(self, controller):
+        """Speak the protocol of the given controller module."""
+        self.controller = controller
+        self.protocol = "json"
+        self.decompressor = None
+        self.cpus = None
+        self.timed = False
+        self.values = False
+        self.reduce = False
+        self.executors = ["process"]
+        # The shared data files whose copies differ from the host's, or None
+        # if the controller doesn't check them.
+        self.stale = None
+        self.profiled = False
+        # How long the controller and the host spent on the last result.
+        self.timings = {}
+
+    def _hello(self, compress, options):
+        """Return the message that asks for the binary protocol.
+
+        `options` are the project settings the controller needs to know.
+        """
+        hello = {"protocol": self.controller.PROTOCOL, "options": options,
+                 "timings": True}
+        if compress:
+            hello["compression"] = "zlib"
+        return self._line({"start": 0, "stop": 0, "hello": hello})
+
+    def _accept(self, line):
+        """Take up whatever the controller agreed to in its reply.
+
+        A reply that isn't a hello, like the empty block that controllers
+        from before the binary protocol answer with, keeps the session on
+        json lines.
+        """
+        try:
+            message = self._decode_line(line)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            return
+        hello = message.get("hello")
+        if hello is not None and (
+                hello.get("protocol") == self.controller.PROTOCOL):
+            self.protocol = hello["protocol"]
+            self.cpus = hello.get("cpus")
+            self.timed = bool(hello.get("timings"))
+            self.values = bool(hello.get("values"))
+            self.reduce = bool(hello.get("reduce"))
+            self.executors = hello.get("executors", ["process"])
+            self.stale = hello.get("stale")
+            self.profiled = bool(hello.get("profile"))
+            if hello.get("compression") == "zlib":
+                self.decompressor = zlib.decompressobj()
+
+    def _block(self, bounds, inputs=None):
+        """Return the message asking for the results of a block.
+
+        The block is range(*bounds) unless it has a list of `inputs`.
+        """
+        if inputs is not None:
+            return self.controller.pack_values(bounds[0], bounds[1], inputs)
+        if self.protocol == "json":
+            return self._line({"start": bounds[0], "stop": bounds[1]})
+        return self.controller.pack_block(*bounds)
+
+    def _end(self):
+        """Return the message that tells the controller to shut down."""
+        if self.protocol == "json":
+            return b"end\n"
+        return self.controller.pack_end()
+
+    def _parse_line(self, line):
+        """Return the results in a json line from the controller.
+
+        Raises _FunctionError if the controller sent an error instead.
+        """
+        began = time.time()
+        message = self._decode_line(line)
+        if "error" in message:
+            raise _FunctionError(message["error"])
+        values = [pair[1] for pair in message["solution"]]
+        self.timings = {"decode": time.time() - began}
+        return values
+
+    @staticmethod
+    def _decode_line(line):
+        """Return the json message in a line from the controller."""
+        if line.endswith(b"$"):
+            # Controllers older than the framed protocol end with a "$"
+            line = line[:-1]
+        return json.loads(line.decode("utf-8"))
+
+    def _parse_frame(self, payload):
+        """Return the results in the payload of a binary frame."""
+        began = time.time()
+        self.timings = {}
+        if self.timed:
+            size = self.controller.TIMINGS.size
+            self.timings = dict(zip(
+                ("idle", "queue", "compute", "encode"),
+                self.controller.TIMINGS.unpack(payload[:size])))
+            payload = payload[size:]
+        if self.decompressor is not None:
+            payload = self.decompressor.decompress(payload)
+        values = self.controller.decode_values(payload)
+        self.timings["decode"] = time.time() - began
+        return values
+
+    @staticmethod
+    def _parse_notice(payload):
+        """Return the profile in a frame that follows an empty one.
+
+        Raises _FunctionError if the frame holds an error instead.
+        """
+        message = json.loads(zlib.decompress(payload).decode("utf-8"))
+        if "error" in message:
+            raise _FunctionError(message["error"])
+        return message["profile"]
+
+    @staticmethod
+    def _line(message):
+        """Return a single json message as a line."""
+        return json.dumps(message).encode("utf-8") + b"\n"
+
+
+class _FunctionError(Exception):
+    """The project's function raised an error on a worker.
+
+    The message is the traceback of the error.
+    """
+
+
+class _Connection(_Session):
+    """The host's end of a session with a controller in a subprocess."""
+
+    def __init__(self, proc, controller):
+        """Talk to the controller running in the given process."""
+        super(_Connection, self).__init__(controller)
+        self.proc = proc
+        self.reader = _StreamReader(proc.stdout)
+
+    def negotiate(self, compress, options):
+        """Ask the controller for the binary protocol.
+
+        `options` are the project settings the controller needs to know.
+        Raises EOFError if the controller exits before answering.
+        """
+        self._send(self._hello(compress, options))
+        self._accept(self.reader.read_line())
+
+    def send_block(self, bounds, inputs=None):
+        """Ask the controller for the results of a block.
+
+        The block is range(*bounds) unless it has a list of `inputs`.
+        """
+        self._send(self._block(bounds, inputs))
+
+    def read_result(self, bounds, timeout=None):
+        """Return the results for the block, or None if they are not ready.
+
+        Raises EOFError if the controller has gone away and _FunctionError
+        if the function failed.
+        """
+        if self.protocol == "json":
+            line = self.reader.read_line(timeout)
+            return None if line is None else self._parse_line(line)
+        payload = self.reader.read_frame(self.controller.HEADER, timeout)
+        if payload is None:
+            return None
+        if len(payload) == 0:
+            self._parse_notice(
+                self.reader.read_frame(self.controller.HEADER))
+            raise EOFError("connection closed")
+        return self._parse_frame(payload)
+
+    def close(self):
+        """Tell the controller to shut down."""
+        self.proc.stdin.write(self._end())
+        self.proc.stdin.close()
+
+    def _send(self, message):
+        """Send a message to the controller."""
+        self.proc.stdin.write(message)
+        self.proc.stdin.flush()
+
+
+class _AsyncConnection(_Session):
+    """The host's end of a session with a controller, driven by asyncio.
+
+    Blocks are buffered by send_block until flush() is awaited.
+    """
+
+    def __init__(self, proc, controller):
+        """Talk to the controller running in the given process."""
+        super(_AsyncConnection, self).__init__(controller)
+        self.proc = proc
+
+    async def negotiate(self, compress, options):
+        """Ask the controller for the binary protocol.
+
+        `options` are the project settings the controller needs to know.
+        Raises EOFError if the controller exits before answering.
+        """
+        self.proc.stdin.write(self._hello(compress, options))
+        await self.flush()
+        self._accept(await self._read_line())
+        return self.protocol
+
+    def send_block(self, bounds, inputs=None):
+        """Ask the controller for the results of a block.
+
+        The block is range(*bounds) unless it has a list of `inputs`.
+        """
+        self.proc.stdin.write(self._block(bounds, inputs))
+
+    async def flush(self):
+        """Wait until the pipe to the controller has room again."""
+        await self.proc.stdin.drain()
+
+    async def read_result(self):
+        """Return the results for the next block.
+
+        Raises EOFError if the controller has gone away and _FunctionError
+        if the function failed.
+        """
+        if self.protocol == "json":
+            return self._parse_line(await self._read_line())
+        payload = await self._read_frame()
+        if len(payload) == 0:
+            # A profile only follows the last result, so this is an error.
+            self._parse_notice(await self._read_frame())
+            raise EOFError("connection closed")
+        return self._parse_frame(payload)
+
+    async def read_profile(self):
+        """Return the samples the controller sends after its last result.
+
+        Results for blocks that were still running are skipped. Raises
+        EOFError if the controller exits without sending them.
+        """
+        while True:
+            # An empty frame comes just before the profile.
+            if len(await self._read_frame()) == 0:
+                return self._parse_notice(await self._read_frame())
+
+    def close(self):
+        """Tell the controller to shut down."""
+        self.proc.stdin.write(self._end())
+        self.proc.stdin.close()
+
+    async def wait_closed(self):
+        """Wait for the controller to exit, dropping anything it sends."""
+        while await self.proc.stdout.read(1 << 16):
             pass
-    finally:
-        # print("end", file=rem_in)
-        # proc.communicate(input="end")
-        print("end", file=proc.stdin)
+        await self.proc.wait()
+
+    async def _read_frame(self):
+        """Return the payload of the next frame from the controller."""
+        header = self.controller.HEADER
+        try:
+            length = header.unpack(
+                await self.proc.stdout.readexactly(header.size))[0]
+            return await self.proc.stdout.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise EOFError("connection closed")
+
+    async def _read_line(self):
+        """Return the next non-empty line from the controller."""
+        while True:
+            line = await self.proc.stdout.readline()
+            if not line:
+                raise EOFError("connection closed")
+            if line.strip():
+                return line.strip()
+
+
+class _StreamReader(object):
+    """Read lines and length-prefixed frames from a pipe.
+
+    Reads wait on the pipe with select so that they can give up after a
+    timeout instead of blocking forever. A read that times out part way
+    through a message keeps what it has received for the next call.
+    """
 
+    def __init__(self, stream):
+        """Wrap the given binary stream."""
+        self.fd = stream.fileno()
+        self.buffer = bytearray()
+
+    def read_line(self, timeout=None):
+        """Return the next non-empty line, or None if none arrived in time.
+
+        Raises EOFError if the other end closed the pipe.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            while b"\n" not in self.buffer:
+                if not self._receive(deadline):
+                    return None
+            end = self.buffer.index(b"\n")
+            line = bytes(self.buffer[:end]).strip()
+            del self.buffer[:end + 1]
+            if line:
+                return line
+
+    def read_frame(self, header, timeout=None):
+        """Return the payload of the next frame, or None if not in time.
+
+        `header` is the struct that encodes the length of each frame.
+        Raises EOFError if the other end closed the pipe.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while len(self.buffer) < header.size:
+            if not self._receive(deadline):
+                return None
+        end = header.size + header.unpack(
+            bytes(self.buffer[:header.size]))[0]
+        while len(self.buffer) < end:
+            if not self._receive(deadline):
+                return None
+        payload = bytes(self.buffer[header.size:end])
+        del self.buffer[:end]
+        return payload
+
+    def _receive(self, deadline):
+        """Wait for more data until the deadline, returning if any came."""
+        wait = None if deadline is None else deadline - time.time()
+        if wait is not None and wait <= 0:
+            return False
+        ready, _, _ = select.select([self.fd], [], [], wait)
+        if not ready:
+            return False
+        chunk = os.read(self.fd, 1 << 20)
+        if not chunk:
+            raise EOFError("connection closed")
+        self.buffer += chunk
+        return True
+
+
+def _load_controller(data):
+    """Import the controller module that is deployed with the project.
+
+    The host uses it to speak the same wire protocol as the servers.
+    """
+    if data.get("local"):
+        path = os.getcwd()
+    else:
+        path = os.path.expanduser("~/.cerberus")
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return importlib.import_module("controller")
 
-def local_runner(blocks, results_queue, data, end_event):
-    """Set up a process to complete part of a run locally."""
-    module = __import__(data["file"])
-    function = getattr(module, data["function"])
 
-    pool = multiprocessing.Pool(max(multiprocessing.cpu_count() - 1, 1))
-    try:
-        while not end_event.is_set():
-            block_id, bounds = blocks.get(False)
+def _load_project(data):
+    """Import the project's module from the current directory."""
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    return importlib.import_module(data["file"])
 
-            inlist = list(range(bounds[0], bounds[1]))
-            result = pool.map(function, inlist)
-            out = zip(inlist, result)
-            results_queue.put((block_id, out))
-            blocks.task_done()
 
-    except queue.Empty:
-        pass
+def _local_cores():
+    """Return how many worker processes to run on the host."""
+    return max(multiprocessing.cpu_count() - 1, 1)
+
+
+async def local_runner(coordinator, data, source, calibration=None,
+                       profile=False):
+    """Run part of the project in the project's executor on the host.
+
+    If `profile` is true the pool's workers are sampled too.
+    """
+    function = getattr(_load_project(data), data["function"])
+    controller = _load_controller(data)
+    options = dict(_local_options(data), profile=profile)
+    blocks = coordinator.blocks
+    loop = asyncio.get_event_loop()
+
+    cpus = _local_cores()
+    workers = controller.concurrency(cpus, options)
+    pool = controller.make_pool(workers, data["file"], options)
+    blocks.register("local", cpus, calibration)
+    last_result = time.time()
+    stuck = False
+    try:
+        while not coordinator.stop.is_set():
+            block = blocks.take("local")
+            if block is None:
+                # More work can turn up if another worker fails.
+                if blocks.finished():
+                    break
+                await _pause(coordinator.stop, POLL_TIMEOUT)
+                continue
+            block_id, bounds = block
+
+            start = time.time()
+            result = controller.start_block(
+                pool, function, bounds, options, workers,
+                source.shipped(bounds))
+            # Wait in a thread so that the other workers carry on.
+            while not result.ready() and not coordinator.stop.is_set():
+                await loop.run_in_executor(None, result.wait, POLL_TIMEOUT)
+            if not result.ready():
+                # The run is over without this block, which other workers
+                # may have finished, so stop the pool rather than wait.
+                stuck = True
+                return
+            try:
+                values = result.get()
+            except Exception:
+                raise _FunctionError(traceback.format_exc())
+            now = time.time()
+            first = blocks.done("local", block_id, bounds[1] - bounds[0],
+                                now - start)
+            timings = {"worker": "local", "idle": start - last_result,
+                       "compute": now - start}
+            last_result = now
+            coordinator.save(
+                block_id, bounds, values if first else None, timings)
+
+        await loop.run_in_executor(None, controller.finish_pool, pool)
 
     finally:
-        pool.close()
-        pool.join()
+        pool.terminate()
+        if not stuck:
+            # Threads can't be stopped, so a stuck one isn't waited for.
+            pool.join()
 
 
 if __name__ == '__main__':
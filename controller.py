@@ -2,12 +2,145 @@
 
 This program takes the nubmer or cpus to use, the name of the function, and
 the name of the module to use as arguments. Blocks are passed in through
-stdin and results are returned as json to stdout.
+stdin and results are returned to stdout.
+
+The host opens the session with a json line that asks for the binary
+protocol. Controllers that do not understand the request answer it as an
+empty block, so the host falls back to sending one json message per line.
+Otherwise both sides switch to length-prefixed binary frames where results
+are sent as a dense array in input order and may be zlib compressed. If
+the host asks for timings each result frame starts with how long the block
+waited, ran and took to encode. Projects with a reduce function get a single
+partial result back for each block, and filtered projects get the
+[input, result] pairs whose result is not None. The function runs in a pool
+of processes, or for functions that mostly wait, in a pool of threads or as
+coroutines on an event loop. Large read-only files the project declares as
+shared are mapped into memory rather than read by each worker, and are
+checked against the host's copies before any blocks are run. If the host
+asks for a profile, every process samples its stacks while it uses the cpu
+and the counts are sent back after the last result.
+
+With --agent this program instead manages an agent that keeps a warm pool
+for each project on this machine and takes jobs on a local tcp port. Runs
+reach it with --connect, which relays the session to the agent, or runs it
+here if no agent is listening. An agent shares the machine's cores between
+the jobs it is running by their priority, resizing each job's pool as jobs
+come and go.
 """
 from __future__ import print_function
+import binascii
+import collections
+import errno
+import functools
+import hashlib
+import inspect
+import itertools
 import json
+import mmap
 import multiprocessing
+import multiprocessing.pool
+import multiprocessing.reduction
+import multiprocessing.util
+import os
+import signal
+import socket
+import struct
 import sys
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+PROTOCOL = "binary"
+
+# Frame types sent by the host. A block of values is sent for inputs other
+# than a range of integers.
+BLOCK = b"B"
+VALUES = b"V"
+END = b"E"
+
+# Encodings for an array of results.
+INTS = b"q"
+FLOATS = b"d"
+JSON = b"j"
+
+HEADER = struct.Struct(">I")
+BOUNDS = struct.Struct(">qq")
+
+# Seconds the pool sat idle before a block arrived, the block waited behind
+# earlier ones, it took to run and its results took to encode.
+TIMINGS = struct.Struct(">dddd")
+
+# In batch mode each block is split into this many chunks per cpu.
+CHUNKS_PER_CPU = 4
+
+# Seconds of cpu time between samples of the stacks of each process while
+# profiling, and how many frames of each stack are kept.
+PROFILE_INTERVAL = 0.01
+PROFILE_DEPTH = 64
+
+# Innermost frames of threads that are waiting rather than using the cpu,
+# which are left out of profiles, by file and function.
+IDLE_FRAMES = frozenset([
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"), ("selectors.py", "select"),
+    ("connection.py", "_recv"), ("connection.py", "_poll"),
+    ("pool.py", "worker"), ("pool.py", "_handle_workers"),
+    ("pool.py", "_handle_tasks"), ("pool.py", "_handle_results"),
+    ("pool.py", "_wait_for_updates"), ("thread.py", "_worker"),
+    ("unix_events.py", "_do_waitpid"),
+    ("socket.py", "readinto"), ("socket.py", "accept"),
+    ("controller.py", "read_block")])
+
+# How many calls each executor runs at once per core unless the project
+# sets its concurrency. Threads and coroutines are meant for functions that
+# mostly wait, so many more of them can run than there are cores.
+PER_CORE = {"process": 1, "thread": 16, "async": 64}
+
+# Where an agent keeps its log and the token that jobs must present,
+# relative to the directory it was started in.
+AGENT_LOG = ".cerberus/agent.log"
+AGENT_TOKEN = ".cerberus/agent.token"
+# Seconds an agent is given to answer a command.
+AGENT_WAIT = 5.0
+
+# File in a project's directory on a server that remembers the sha256 of each
+# shared data file along with its size, inode and modification and change
+# times, so that it is only read again once it changes.
+SHARED_DIGESTS = "shared.sha256"
+
+# The directory of the project being served, which its files are deployed
+# into alongside this program.
+PROJECT = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds between checks on whether the host has given up on the block
+# being waited for, and that the thread reading blocks is given to finish
+# once the session is over.
+END_POLL = 0.1
+READER_WAIT = 5.0
+
+# An agent shares its machine's cores between at most MAX_JOBS running jobs.
+# Jobs that have no cores check again every SLOT_POLL seconds.
+MAX_JOBS = 64
+SLOT_POLL = 0.1
+
+# The extra arguments passed to the function in this pool worker (the
+# state built by the project's setup function) and any error from setup.
+WORKER_ARGS = ()
+SETUP_ERROR = None
+
+# The profiler sampling this process, while profiling.
+PROFILER = None
 
 
 def main(cpus, module_name, function_name):
@@ -24,35 +157,1583 @@ def main(cpus, module_name, function_name):
 
         print("cpus: " + str(cpus), file=f)
         f.flush()
+        channel = open_channel(
+            getattr(sys.stdin, "buffer", sys.stdin),
+            getattr(sys.stdout, "buffer", sys.stdout), cpus)
+        print("protocol: " + channel.name, file=f)
+        print("options: " + json.dumps(channel.options), file=f)
+        f.flush()
+        if channel.options.get("profile"):
+            start_profiler("controller")
+        workers = concurrency(cpus, channel.options)
+        pool = make_pool(workers, module_name, channel.options)
+        # Set after the pool has started so that its workers are still
+        # stopped straight away.
+        signal.signal(signal.SIGTERM, stop_serving)
         try:
-            pool = multiprocessing.Pool(cpus)
-
-            block = raw_input()
-            print("recvd block: " + block, file=f)
-            f.flush()
-            while block != "end":
-                data = json.loads(block)
-                inlist = list(range(data["start"], data["stop"]))
-                result = pool.map(function, inlist)
-                out = zip(inlist, result)
-                final_result = json.dumps({"solution": out})
-                print("result: " + final_result, file=f)
-                print(final_result + "$", file=sys.stdout)
-                sys.stdout.flush()
-                f.flush()
-                block = raw_input()
-                print("recvd block: " + block, file=f)
+            serve(channel, pool, function, workers, f)
+            finish_pool(pool)
 
+        except (IOError, OSError, EOFError) as error:
+            # The host has gone, or has given up on the blocks still
+            # running, so nothing more is sent.
+            print("session ended: " + repr(error), file=f)
+            quiet_stdout()
+        except Exception:
+            # The function failed, which serve has told the host about.
+            print("function failed:\n" + traceback.format_exc(), file=f)
+            quiet_stdout()
         finally:
             print("terminating...", file=f)
             pool.terminate()
             pool.join()
-            print("done")
+
+
+def finish_pool(pool):
+    """Wait for a pool's workers once there is no more work for them.
+
+    The workers are left to exit on their own rather than being terminated
+    so that the project's teardown function runs in each of them.
+    """
+    pool.close()
+    pool.join()
+
+
+def quiet_stdout():
+    """Send anything still written to stdout nowhere."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
+def serve(channel, pool, function, cpus, log):
+    """Run every block the host sends over a channel until it is done.
+
+    Raises EOFError if the host ends the session while blocks it no longer
+    wants are still running, which are left for the caller to stop. If the
+    function raises, its traceback is sent to the host and the exception
+    is raised again once the host has ended the session.
+    """
+    # Blocks are handed to the pool as soon as they arrive so that it keeps
+    # working while earlier results are sent back.
+    pending = queue.Queue()
+    ended = threading.Event()
+    reader = threading.Thread(target=submit_blocks, args=(
+        channel, pool, function, cpus, pending, ended))
+    reader.daemon = True
+    reader.start()
+    try:
+        # The pool works through blocks in the order they arrive, so each
+        # one starts once it has arrived and the previous one is finished.
+        last = time.time()
+        item = pending.get()
+        while item is not None:
+            bounds, result, received = item
+            while not result.ready() and not ended.is_set():
+                result.wait(END_POLL)
+            if not result.ready():
+                if PROFILER is not None:
+                    channel.write_profile(stop_profiler())
+                raise EOFError("the host ended the session with blocks "
+                               "still running")
+            try:
+                values = result.get()
+                finished = time.time()
+                started = max(received, last)
+                channel.write_result(bounds, values, (
+                    max(received - last, 0.0), started - received,
+                    finished - started))
+            except (IOError, OSError, EOFError):
+                raise
+            except Exception:
+                # The host ends the session once it hears of the error,
+                # which lets the reader finish before this returns.
+                channel.write_error(traceback.format_exc())
+                raise
+            last = finished
+            print("sent block: " + str(bounds), file=log)
+            log.flush()
+            item = pending.get()
+        if PROFILER is not None:
+            channel.write_profile(stop_profiler())
+    finally:
+        # A reader still using stdin can crash the interpreter as it shuts
+        # down. It stops once the host closes its end, which the host does
+        # before killing this process.
+        reader.join(READER_WAIT)
+
+
+def submit_blocks(channel, pool, function, cpus, pending, ended):
+    """Start work on each block as it is read from the host.
+
+    Each block is put on `pending` along with its result handle and the time
+    it arrived, followed by None once the host ends the session. `ended` is
+    set then if the host doesn't want the results of blocks still running.
+    """
+    try:
+        block = channel.read_block()
+        while block is not None:
+            bounds, inputs = block
+            pending.put((bounds, start_block(
+                pool, function, bounds, channel.options, cpus, inputs),
+                time.time()))
+            block = channel.read_block()
+    finally:
+        if channel.abandons:
+            ended.set()
+        pending.put(None)
+
+
+def stop_serving(signum, frame):
+    """Exit through the usual clean up when the host kills this process."""
+    sys.exit(1)
+
+
+def concurrency(cores, options, share=None):
+    """Return how many calls to run at once on `cores` cores.
+
+    That is the project's concurrency setting if it has one, and otherwise
+    depends on its executor. An agent may give the job only `share` of the
+    cores, which cuts it down in proportion.
+    """
+    if share is None:
+        share = cores
+    if options.get("concurrency"):
+        return max(options["concurrency"] * share // cores, 1)
+    return share * PER_CORE[options.get("executor") or "process"]
+
+
+def make_pool(size, module_name, options):
+    """Create the pool for the executor named in `options`.
+
+    Process pools run the project's setup in each worker. The setup and
+    teardown functions are named in `options` and are found in the same
+    module as the function being run.
+    """
+    executor = options.get("executor") or "process"
+    if executor == "thread":
+        return ThreadExecutor(size, module_name, options)
+    if executor == "async":
+        return AsyncExecutor(size, module_name, options)
+    if not (options.get("setup") or options.get("teardown")
+            or options.get("shared") or options.get("profile")):
+        return multiprocessing.Pool(size)
+    pool = multiprocessing.Pool(
+        size, init_worker,
+        (module_name, options.get("setup"), options.get("teardown"),
+         shared_paths(options), bool(options.get("profile"))))
+    if options.get("profile"):
+        return ProfiledPool(pool)
+    return pool
+
+
+def init_worker(module_name, setup, teardown, shared=None, profile=False):
+    """Build the state for a pool worker and arrange for its teardown.
+
+    If `profile` is true the worker samples its stacks and sends them back
+    with its results.
+    """
+    global PROFILER
+    # A worker forked while this process was profiling has a copy of its
+    # profiler.
+    PROFILER = None
+    if profile:
+        start_profiler("worker")
+    teardown = set_up(module_name, setup, teardown, shared)
+    if teardown is not None:
+        # Runs when the worker exits after the pool is closed.
+        multiprocessing.util.Finalize(
+            None, teardown, args=WORKER_ARGS, exitpriority=10)
+
+
+def set_up(module_name, setup, teardown, shared=None):
+    """Build the state the function is called with in this process.
+
+    `shared` gives the path of each shared data file by name. The files are
+    mapped and passed to the setup function as a dict, or straight to the
+    function if there is no setup. Returns the teardown function, if there
+    is one. Errors are kept until the first call rather than raised here,
+    where in a pool worker they would only make the pool start another
+    worker.
+    """
+    global WORKER_ARGS, SETUP_ERROR
+    WORKER_ARGS = ()
+    SETUP_ERROR = None
+    try:
+        module = __import__(module_name)
+        files = dict((name, map_file(path))
+                     for name, path in (shared or {}).items())
+        if setup and files:
+            WORKER_ARGS = (getattr(module, setup)(files),)
+        elif setup:
+            WORKER_ARGS = (getattr(module, setup)(),)
+        elif files:
+            WORKER_ARGS = (files,)
+        if teardown:
+            return getattr(module, teardown)
+    except Exception as error:
+        SETUP_ERROR = error
+    return None
+
+
+def shared_paths(options):
+    """Return the path of each shared data file in `options` by name.
+
+    Files are deployed into the project's directory under their names, and
+    the host gives the paths of its own copies.
+    """
+    paths = options.get("paths", {})
+    return dict((name, paths.get(name, os.path.join(PROJECT, name)))
+                for name in options.get("shared", {}))
+
+
+def map_file(path):
+    """Map a shared data file into memory read-only.
+
+    Every process that maps a file shares the same pages, so it is only in
+    memory once however many workers use it. numpy arrays saved with
+    numpy.save are mapped as arrays if numpy is installed, and anything
+    else as an mmap, which works like read-only bytes.
+    """
+    if path.endswith(".npy"):
+        try:
+            import numpy
+            return numpy.load(path, mmap_mode="r")
+        except ImportError:
+            pass
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can't be mapped.
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def shared_digests(directory, names):
+    """Return the sha256 of each of the named files in a directory.
+
+    Digests are remembered in SHARED_DIGESTS in the directory so that large
+    files are only read again once they change. Missing files have a
+    digest of None.
+    """
+    cache = os.path.join(directory, SHARED_DIGESTS)
+    try:
+        with open(cache) as f:
+            known = json.load(f)
+    except (IOError, ValueError):
+        known = {}
+    digests = {}
+    changed = False
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            digests[name] = None
+            continue
+        key = [stat.st_size, stat.st_ino, stat.st_mtime, stat.st_ctime]
+        entry = known.get(name)
+        if entry is None or entry[:4] != key:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            entry = known[name] = key + [digest.hexdigest()]
+            changed = True
+        digests[name] = entry[4]
+    if changed:
+        try:
+            with open(cache, "w") as f:
+                json.dump(known, f)
+        except IOError:
+            pass
+    return digests
+
+
+class ThreadExecutor(object):
+    """Run the function on a pool of threads in this process.
+
+    Setup runs once and every thread shares its state. Nothing has to be
+    pickled, which suits functions that wait on i/o or release the GIL.
+    """
+
+    def __init__(self, size, module_name, options):
+        """Start `size` threads after running the project's setup."""
+        self.teardown = set_up(
+            module_name, options.get("setup"), options.get("teardown"),
+            shared_paths(options))
+        self.args = WORKER_ARGS
+        self.pool = multiprocessing.pool.ThreadPool(size)
+
+    def map_async(self, function, iterable):
+        """Start calling the function on every item."""
+        return self.pool.map_async(function, iterable)
+
+    def close(self):
+        """Take no more work."""
+        self.pool.close()
+
+    def terminate(self):
+        """Stop the threads without waiting for their work."""
+        self.pool.terminate()
+
+    def join(self):
+        """Wait for the threads to exit, then run the project's teardown."""
+        self.pool.join()
+        finish(self)
+
+
+class AsyncExecutor(object):
+    """Run an async def function as coroutines on an event loop.
+
+    The loop runs in a thread of this process and at most `size` calls are
+    in progress at once across every block. Setup runs once and every call
+    shares its state.
+    """
+
+    def __init__(self, size, module_name, options):
+        """Start the event loop after running the project's setup."""
+        if asyncio is None:
+            raise RuntimeError("the async executor needs python 3")
+        self.size = size
+        self.teardown = set_up(
+            module_name, options.get("setup"), options.get("teardown"),
+            shared_paths(options))
+        self.args = WORKER_ARGS
+        # Calls waiting for a turn and the tasks in progress, which are only
+        # touched from the loop's thread.
+        self.waiting = collections.deque()
+        self.running = set()
+        self.results = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def map_async(self, function, iterable):
+        """Start calling the function on every item."""
+        result = AsyncResult(list(iterable))
+        self.results = [
+            other for other in self.results if not other.ready()] + [result]
+        self.loop.call_soon_threadsafe(self._submit, function, result)
+        return result
+
+    def close(self):
+        """Take no more work."""
+
+    def terminate(self):
+        """Cancel every call and stop the loop."""
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._cancel)
+        self._stop()
+
+    def join(self):
+        """Wait for every call to finish, then run the project's teardown."""
+        if self.loop.is_closed():
+            return
+        for result in self.results:
+            result.wait()
+        self._stop()
+        finish(self)
+
+    def _stop(self):
+        """Stop the loop and its thread."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def _submit(self, function, result):
+        """Queue a call for every item of a result."""
+        self.waiting.extend(
+            (function, result, index) for index in range(len(result.items)))
+        self._fill()
+
+    def _fill(self):
+        """Start waiting calls until `size` are in progress."""
+        while len(self.running) < self.size and len(self.waiting) > 0:
+            function, result, index = self.waiting.popleft()
+            if result.ready():
+                # An earlier call for the block failed.
+                continue
+            try:
+                value = function(result.items[index])
+                if not inspect.isawaitable(value):
+                    result.set(index, value)
+                    continue
+                task = asyncio.ensure_future(value, loop=self.loop)
+            except Exception as error:
+                result.fail(error)
+                continue
+            self.running.add(task)
+            task.add_done_callback(
+                functools.partial(self._done, result, index))
+
+    def _done(self, result, index, task):
+        """Record the outcome of a call and start the next one."""
+        self.running.discard(task)
+        if task.cancelled():
+            result.fail(RuntimeError("cancelled"))
+        elif task.exception() is not None:
+            result.fail(task.exception())
+        else:
+            result.set(index, task.result())
+        self._fill()
+
+    def _cancel(self):
+        """Drop the waiting calls and cancel the ones in progress."""
+        for _, result, _ in self.waiting:
+            result.fail(RuntimeError("cancelled"))
+        self.waiting.clear()
+        for task in list(self.running):
+            task.cancel()
+
+
+class AsyncResult(object):
+    """The results of the calls for every item given to map_async."""
+
+    def __init__(self, items):
+        """Wait for a result for each item."""
+        self.items = items
+        self.values = [None] * len(items)
+        self.remaining = len(items)
+        self.error = None
+        self.event = threading.Event()
+        if self.remaining == 0:
+            self.event.set()
+
+    def set(self, index, value):
+        """Record the result for one item."""
+        self.values[index] = value
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.event.set()
+
+    def fail(self, error):
+        """Give up on the results because a call failed."""
+        if self.error is None:
+            self.error = error
+        self.event.set()
+
+    def ready(self):
+        """Return whether every call has finished."""
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until every call has finished or the timeout passes."""
+        self.event.wait(timeout)
+
+    def get(self):
+        """Wait for every call and return their results in order."""
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.values
+
+
+class ProfiledPool(object):
+    """A process pool whose workers send samples of their stacks back.
+
+    Each call returns its result along with the samples taken since the
+    worker's last call, which are added to this process's profiler.
+    """
+
+    def __init__(self, pool):
+        """Wrap a pool whose workers are profiling."""
+        self.pool = pool
+
+    def map_async(self, function, iterable):
+        """Start calling the function on every item."""
+        return ProfiledResult(self.pool.map_async(
+            functools.partial(run_sampled, function), iterable))
+
+    def close(self):
+        """Take no more work."""
+        self.pool.close()
+
+    def terminate(self):
+        """Stop the workers straight away."""
+        self.pool.terminate()
+
+    def join(self):
+        """Wait for the workers to exit."""
+        self.pool.join()
+
+
+def run_sampled(function, item):
+    """Return the function's result for an item and the new samples."""
+    return function(item), PROFILER.take() if PROFILER is not None else None
+
+
+def finish(executor):
+    """Run the teardown of an executor that runs in this process.
+
+    The state it shares is forgotten afterwards, unless a newer executor has
+    replaced it, so that process pools forked later don't inherit it.
+    """
+    global WORKER_ARGS, SETUP_ERROR
+    if executor.teardown is not None:
+        teardown, executor.teardown = executor.teardown, None
+        teardown(*executor.args)
+    if WORKER_ARGS is executor.args:
+        WORKER_ARGS = ()
+        SETUP_ERROR = None
+
+
+def start_block(pool, function, bounds, options, cpus, inputs=None):
+    """Start work on a block and return a handle with a get() method.
+
+    The block's inputs are range(*bounds) unless they are given in `inputs`.
+    In batch mode the function is called once per chunk of the block with
+    the chunk's start and stop (or with a list of the chunk's inputs), and
+    returns the results for every value in it. Otherwise it is called once
+    for every value. If the project has a setup function its result, or
+    else its shared data, is passed to the function as an extra last
+    argument.
+    """
+    if (options.get("reduce") or options.get("filter")) and (
+            options.get("executor") or "process") != "process":
+        # Nothing has to be sent between processes, so the results can be
+        # combined once they are all in.
+        return FinishedResult(start_block(
+            pool, function, bounds, dict(options, reduce=None, filter=False),
+            cpus, inputs), find_reducer(function, options),
+            range(*bounds) if inputs is None else inputs)
+    if options.get("reduce") or options.get("filter"):
+        return start_reduced(pool, function, bounds, options, cpus, inputs)
+    if options.get("mode") == "batch":
+        chunks = split(bounds, cpus * CHUNKS_PER_CPU)
+        if inputs is None:
+            return BatchResult(pool.map_async(
+                functools.partial(run_batch, function), chunks))
+        chunks = [inputs[low - bounds[0]:high - bounds[0]]
+                  for low, high in chunks]
+        return BatchResult(pool.map_async(
+            functools.partial(run_batch_inputs, function), chunks))
+    inlist = inputs
+    if inlist is None:
+        inlist = range(bounds[0], bounds[1])
+    if options.get("setup") or options.get("shared"):
+        return pool.map_async(functools.partial(run_value, function), inlist)
+    return pool.map_async(function, inlist)
+
+
+def start_reduced(pool, function, bounds, options, cpus, inputs=None):
+    """Start work on a block whose results are reduced or filtered.
+
+    The block is split into chunks and each pool worker reduces or filters
+    the results of its chunk, so only one partial result per chunk leaves
+    the worker. The reduce function is found in the same module as the
+    function being run.
+    """
+    chunks = split(bounds, cpus * CHUNKS_PER_CPU)
+    if inputs is None:
+        chunks = [(chunk, None) for chunk in chunks]
+    else:
+        chunks = [((low, high), inputs[low - bounds[0]:high - bounds[0]])
+                  for low, high in chunks]
+    reducer = find_reducer(function, options)
+    return ReducedResult(pool.map_async(functools.partial(
+        run_reduced, function, reducer, options.get("mode")), chunks),
+        reducer)
+
+
+def find_reducer(function, options):
+    """Return the project's reduce function, or None if it hasn't one."""
+    if not options.get("reduce"):
+        return None
+    return getattr(sys.modules[function.__module__], options["reduce"])
+
+
+def split(bounds, count):
+    """Split a (start, stop) pair into at most `count` even parts."""
+    start, stop = bounds
+    count = max(min(count, stop - start), 1)
+    edges = [start + (stop - start) * i // count for i in range(count + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def worker_args():
+    """Return the extra arguments for the function in this pool worker."""
+    if SETUP_ERROR is not None:
+        raise SETUP_ERROR
+    return WORKER_ARGS
+
+
+def run_value(function, value):
+    """Return the result of the function for one value and the state."""
+    return function(value, *worker_args())
+
+
+def run_batch(function, bounds):
+    """Return the results of a batch function for a chunk as a list."""
+    return then(
+        function(bounds[0], bounds[1], *worker_args()),
+        functools.partial(batch_results, count=bounds[1] - bounds[0]))
+
+
+def run_batch_inputs(function, inputs):
+    """Return the results of a batch function for a list of inputs."""
+    return then(function(inputs, *worker_args()), functools.partial(
+        batch_results, count=len(inputs)))
+
+
+def then(result, after):
+    """Return after(result), waiting for the result if it is awaitable.
+
+    A coroutine's result is only known once the event loop has run it, so
+    a future of after(result) is returned for the async executor instead.
+    """
+    if asyncio is None or not inspect.isawaitable(result):
+        return after(result)
+    task = asyncio.ensure_future(result)
+    future = asyncio.get_event_loop().create_future()
+
+    def done(task):
+        try:
+            future.set_result(after(task.result()))
+        except Exception as error:
+            future.set_exception(error)
+    task.add_done_callback(done)
+    return future
+
+
+def batch_results(result, count):
+    """Check that a batch function returned `count` results as a list."""
+    if hasattr(result, "tolist"):
+        # numpy arrays, whose elements are not plain python numbers
+        result = result.tolist()
+    result = list(result)
+    if len(result) != count:
+        raise ValueError(
+            "batch function returned " + str(len(result)) + " results for "
+            + str(count) + " values")
+    return result
+
+
+def run_reduced(function, reducer, mode, chunk):
+    """Return the result of a chunk reduced to one value, or filtered.
+
+    `chunk` is the chunk's bounds and its inputs, which are None for a
+    range. Without a reducer the [input, result] pairs whose result is not
+    None are returned instead.
+    """
+    bounds, inputs = chunk
+    if mode == "batch" and inputs is None:
+        results = run_batch(function, bounds)
+    elif mode == "batch":
+        results = run_batch_inputs(function, inputs)
+    if inputs is None:
+        inputs = range(*bounds)
+    if mode != "batch":
+        args = worker_args()
+        results = [function(value, *args) for value in inputs]
+    return combine(reducer, inputs, results)
+
+
+def combine(reducer, inputs, results):
+    """Reduce the results for some inputs to one value, or filter them.
+
+    Without a reducer the [input, result] pairs whose result is not None
+    are returned instead.
+    """
+    if reducer is not None:
+        return functools.reduce(reducer, results)
+    return [[value, result] for value, result in zip(inputs, results)
+            if result is not None]
+
+
+class ChunkedResult(object):
+    """Wait on the pool's handle for the results of every chunk of a block.
+    """
+
+    def __init__(self, result):
+        """Wrap the pool's handle for the list of chunk results."""
+        self.result = result
+
+    def ready(self):
+        """Return whether every chunk has finished."""
+        return self.result.ready()
+
+    def wait(self, timeout=None):
+        """Wait until every chunk has finished or the timeout passes."""
+        self.result.wait(timeout)
+
+
+class ReducedResult(ChunkedResult):
+    """Combine the partial results of every chunk of a block."""
+
+    def __init__(self, result, reducer):
+        """Wrap the pool's handle for the list of chunk results."""
+        super(ReducedResult, self).__init__(result)
+        self.reducer = reducer
+
+    def get(self):
+        """Wait for every chunk and return the results for the block.
+
+        That is a list holding the reduced value, or the filtered pairs.
+        """
+        partials = self.result.get()
+        if self.reducer is not None:
+            return [functools.reduce(self.reducer, partials)]
+        return list(itertools.chain.from_iterable(partials))
+
+
+class BatchResult(ChunkedResult):
+    """Join the results of every chunk of a block in batch mode."""
+
+    def get(self):
+        """Wait for every chunk and return the results for the block."""
+        return list(itertools.chain.from_iterable(self.result.get()))
+
+
+class ProfiledResult(ChunkedResult):
+    """Separate the results of a profiled pool from its samples."""
+
+    def get(self):
+        """Wait for every call and return their results in order."""
+        pairs = self.result.get()
+        for _, samples in pairs:
+            if samples and PROFILER is not None:
+                PROFILER.add(samples)
+        return [value for value, _ in pairs]
+
+
+class Profiler(object):
+    """Sample the stacks of this process while it uses the cpu.
+
+    SIGPROF arrives every PROFILE_INTERVAL seconds of cpu time that the
+    process uses, and the stack of every thread that isn't waiting is
+    counted, so each stack's count is in proportion to the time spent in
+    it. Stacks are kept in the folded format that flame graph tools read:
+    the frames, outermost first and starting with the process's `role`,
+    joined by semicolons.
+    """
+
+    def __init__(self, role):
+        """Sample this process, which plays the given role in the run."""
+        self.role = role
+        self.samples = collections.Counter()
+        self.labels = {}
+
+    def start(self):
+        """Start taking samples."""
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(
+            signal.ITIMER_PROF, PROFILE_INTERVAL, PROFILE_INTERVAL)
+
+    def stop(self):
+        """Stop taking samples."""
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+    def sample(self, signum, frame):
+        """Count the stack of every thread that is using the cpu."""
+        frames = sys._current_frames()
+        # The handler runs in the main thread, on top of what it was doing.
+        frames[threading.current_thread().ident] = frame
+        for top in frames.values():
+            stack = []
+            while top is not None and len(stack) < PROFILE_DEPTH:
+                stack.append(self.label(top.f_code))
+                top = top.f_back
+            if len(stack) == 0 or stack[0][0] in IDLE_FRAMES:
+                continue
+            self.samples[";".join(
+                [self.role] + [label for _, label in reversed(stack)])] += 1
+
+    def label(self, code):
+        """Return the file and function of a code object and its label."""
+        label = self.labels.get(code)
+        if label is None:
+            filename = os.path.basename(code.co_filename)
+            label = self.labels[code] = ((filename, code.co_name), (
+                code.co_name + " (" + filename + ":"
+                + str(code.co_firstlineno) + ")"))
+        return label
+
+    def take(self):
+        """Return the samples taken since the last call, or None."""
+        samples, self.samples = self.samples, collections.Counter()
+        return dict(samples) or None
+
+    def add(self, samples):
+        """Count samples taken by another process."""
+        self.samples.update(samples)
+
+
+def start_profiler(role):
+    """Start sampling this process, which plays the given role."""
+    global PROFILER
+    PROFILER = Profiler(role)
+    PROFILER.start()
+
+
+def stop_profiler():
+    """Stop sampling this process and return the samples."""
+    global PROFILER
+    profiler, PROFILER = PROFILER, None
+    profiler.stop()
+    return dict(profiler.samples)
+
+
+def can_profile():
+    """Return whether processes can be profiled here."""
+    return hasattr(signal, "setitimer") and hasattr(sys, "_current_frames")
+
+
+class FinishedResult(ChunkedResult):
+    """Reduce or filter the results of a whole block once they are in."""
+
+    def __init__(self, result, reducer, inputs):
+        """Wrap the handle for the results of a block's inputs."""
+        super(FinishedResult, self).__init__(result)
+        self.reducer = reducer
+        self.inputs = inputs
+
+    def get(self):
+        """Wait for the block and return the reduced value or the pairs."""
+        combined = combine(self.reducer, self.inputs, self.result.get())
+        if self.reducer is not None:
+            return [combined]
+        return combined
+
+
+def start_agent(port):
+    """Start an agent in the background, returning once it is listening.
+
+    Agents are shared by every project on the machine, so if one is already
+    listening on the port this project's jobs are left to it. Raises an
+    error if the agent could not listen, eg. if something else has the port.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        listener.bind(("127.0.0.1", port))
+    except (IOError, OSError) as error:
+        listener.close()
+        reply = ask_agent(port, "status") if (
+            error.errno == errno.EADDRINUSE) else None
+        if reply is None or "error" in reply:
+            raise
+        print("already running on port " + str(port) + " (pid "
+              + str(reply["pid"]) + ")")
+        return
+    listener.listen(16)
+    token = binascii.hexlify(os.urandom(16)).decode("ascii")
+    if os.path.exists(AGENT_TOKEN):
+        os.remove(AGENT_TOKEN)
+    with os.fdopen(os.open(
+            AGENT_TOKEN, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600),
+            "w") as f:
+        f.write(token)
+
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid > 0:
+        print("started on port " + str(port) + " (pid " + str(pid) + ")")
+        return
+    # Detach from the session that started the agent so that it can end.
+    os.setsid()
+    log = os.open(AGENT_LOG, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    try:
+        Agent(listener, token).serve_forever()
+    finally:
+        os._exit(0)
+
+
+def ask_agent(port, command):
+    """Send a command to the agent listening on `port` and return its reply.
+
+    Returns None if no agent answers.
+    """
+    try:
+        with open(AGENT_TOKEN) as f:
+            token = f.read().strip()
+        sock = socket.create_connection(("127.0.0.1", port), AGENT_WAIT)
+    except (IOError, OSError):
+        return None
+    try:
+        sock.sendall(json.dumps(
+            {"token": token, "command": command}).encode("utf-8") + b"\n")
+        return json.loads(read_header(sock))
+    except (IOError, OSError, EOFError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def request_agent(port, command):
+    """Send a command to the agent listening on `port` and print its reply.
+    """
+    reply = ask_agent(port, command)
+    if reply is None:
+        print("not running")
+    elif "error" in reply:
+        print("error: " + reply["error"])
+    elif command == "stop":
+        print("stopped")
+    else:
+        print("running on port " + str(port) + " (pid " + str(reply["pid"])
+              + ", up " + str(int(reply["uptime"])) + "s), "
+              + str(len(reply["projects"])) + " project(s) loaded, "
+              + str(reply["jobs"]) + " job(s) run")
+        for project in reply["projects"]:
+            print("  " + project["directory"] + ": " + project["file"] + "."
+                  + project["function"] + ", " + str(project["jobs"])
+                  + " job(s)")
+        for job in reply.get("running", []):
+            print("  running job with priority " + str(job["priority"])
+                  + ": " + str(job["share"]) + " of " + str(reply["cores"])
+                  + " cores")
+
+
+def connect(port, cpus, module_name, function_name):
+    """Run a job on the agent listening on `port`.
+
+    This process relays its stdin and stdout to the agent, which runs the
+    job in the warm pool for this project. If there is no agent the job is
+    run here instead.
+    """
+    try:
+        with open(AGENT_TOKEN) as f:
+            token = f.read().strip()
+        sock = socket.create_connection(("127.0.0.1", port))
+    except (IOError, OSError):
+        return main(cpus, module_name, function_name)
+
+    sock.sendall(json.dumps({
+        "token": token,
+        "directory": os.path.dirname(os.path.abspath(__file__)),
+        "cores": cpus, "file": module_name,
+        "function": function_name}).encode("utf-8") + b"\n")
+    sender = threading.Thread(target=relay_to_agent, args=(sock,))
+    sender.daemon = True
+    sender.start()
+    while True:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            break
+        write_all(sys.stdout.fileno(), chunk)
+    sock.close()
+
+
+def relay_to_agent(sock):
+    """Copy stdin to the agent until it is closed."""
+    try:
+        while True:
+            chunk = os.read(sys.stdin.fileno(), 1 << 16)
+            if not chunk:
+                break
+            sock.sendall(chunk)
+        sock.shutdown(socket.SHUT_WR)
+    except (IOError, OSError):
+        pass
+
+
+def write_all(fd, data):
+    """Write all of `data` to a file descriptor."""
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+
+def read_header(sock):
+    """Read one line from a socket without reading any further."""
+    line = bytearray()
+    while not line.endswith(b"\n"):
+        byte = sock.recv(1)
+        if not byte:
+            raise EOFError("connection closed")
+        line += byte
+    return line.decode("utf-8")
+
+
+class Agent(object):
+    """Hand jobs to a warm process for each project.
+
+    Each project is served by a process of its own that keeps its module
+    imported and its pool running between jobs, so projects whose modules
+    have the same name don't clash. The process is replaced when the files
+    deployed for the project change, and another one is started if a job
+    arrives while every process for the project is busy. The machine's
+    cores are shared between the running jobs through `slots`.
+    """
+
+    def __init__(self, listener, token):
+        """Take jobs from a listening socket that present the token."""
+        self.listener = listener
+        self.token = token
+        self.started = time.time()
+        self.jobs = 0
+        # The processes serving each project.
+        self.projects = {}
+        self.slots = Slots(multiprocessing.cpu_count())
+
+    def serve_forever(self):
+        """Take jobs until told to stop or terminated."""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.log("agent started")
+        try:
+            while True:
+                sock, _ = self.listener.accept()
+                # Reap the processes of projects that have been replaced.
+                multiprocessing.active_children()
+                try:
+                    if not self.handle(sock):
+                        break
+                except (IOError, OSError, EOFError, ValueError) as error:
+                    self.log("error handling a request: " + repr(error))
+                finally:
+                    sock.close()
+        finally:
+            for project in self.loaded():
+                project["connection"].send(None)
+            for project in self.loaded():
+                project["process"].join(60)
+            if os.path.exists(AGENT_TOKEN):
+                os.remove(AGENT_TOKEN)
+            self.log("agent stopped")
+
+    def handle(self, sock):
+        """Act on one request, returning False if the agent should stop."""
+        request = json.loads(read_header(sock))
+        if request.get("token") != self.token:
+            self.reply(sock, {"error": "wrong token"})
+            return True
+        command = request.get("command")
+        if command == "stop":
+            self.reply(sock, {})
+            return False
+        if command == "status":
+            self.reply(sock, {
+                "pid": os.getpid(), "uptime": time.time() - self.started,
+                "jobs": self.jobs, "projects": [
+                    dict(project["request"], jobs=project["jobs"])
+                    for project in self.loaded()],
+                "cores": self.slots.cores, "running": self.slots.running()})
+            return True
+
+        key = json.dumps([request["directory"], request["cores"],
+                          request["file"], request["function"]])
+        signature = file_signature(request["directory"])
+        processes = self.projects.setdefault(key, [])
+        for project in list(processes):
+            if (project["signature"] != signature
+                    or not project["process"].is_alive()):
+                self.log("reloading " + request["directory"])
+                project["connection"].send(None)
+                processes.remove(project)
+        idle = [project for project in processes
+                if not project["busy"].value]
+        if len(idle) > 0:
+            project = idle[0]
+        else:
+            project = self.load(request, signature)
+            processes.append(project)
+        # The process marks itself idle again once the job is done.
+        project["busy"].value = 1
+        project["connection"].send("job")
+        multiprocessing.reduction.send_handle(
+            project["connection"], sock.fileno(), project["process"].pid)
+        project["jobs"] += 1
+        self.jobs += 1
+        return True
+
+    def load(self, request, signature):
+        """Start a process to serve a project."""
+        ours, theirs = multiprocessing.Pipe()
+        busy = multiprocessing.Value("b", 0, lock=False)
+        process = multiprocessing.Process(
+            target=serve_project,
+            args=(theirs, request["directory"], request["cores"],
+                  request["file"], request["function"], self.slots, busy))
+        process.start()
+        theirs.close()
+        return {"request": {key: request[key] for key in (
+                    "directory", "cores", "file", "function")},
+                "signature": signature, "process": process,
+                "connection": ours, "jobs": 0, "busy": busy}
+
+    def loaded(self):
+        """Return every process serving a project."""
+        return list(itertools.chain.from_iterable(self.projects.values()))
+
+    def reply(self, sock, message):
+        """Send a json line back to whoever made a request."""
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+    def log(self, message):
+        """Add a line to the agent's log."""
+        print(time.strftime("%Y-%m-%d %H:%M:%S") + " " + message)
+        sys.stdout.flush()
+
+
+class Slots(object):
+    """Share the cores of a machine between the jobs an agent is running.
+
+    The table is in shared memory so that the process serving every project
+    sees the same one. Each running job has an entry with its priority, the
+    most cores it asked for and when it joined, and its share is worked out
+    from the whole table by fair_shares whenever it starts a block.
+    """
+
+    def __init__(self, cores, size=MAX_JOBS):
+        """Make an empty table for a machine with `cores` cores."""
+        self.cores = cores
+        self.lock = multiprocessing.Lock()
+        # A priority of 0 marks an unused entry.
+        self.priorities = multiprocessing.Array("d", size, lock=False)
+        self.limits = multiprocessing.Array("i", size, lock=False)
+        self.joined = multiprocessing.Array("d", size, lock=False)
+
+    def join(self, priority, limit=0):
+        """Add a running job and return its entry.
+
+        `limit` is the most cores the job can use, or 0 for all of them.
+        Returns None if the table is full.
+        """
+        with self.lock:
+            for job in range(len(self.priorities)):
+                if self.priorities[job] == 0:
+                    self.priorities[job] = priority
+                    self.limits[job] = limit or self.cores
+                    self.joined[job] = time.time()
+                    return job
+        return None
+
+    def leave(self, job):
+        """Remove a job once it is done."""
+        with self.lock:
+            self.priorities[job] = 0
+
+    def share(self, job):
+        """Return how many cores a job should use right now."""
+        with self.lock:
+            jobs = self._jobs()
+        shares = fair_shares(self.cores, [entry for _, entry in jobs])
+        return shares[[index for index, _ in jobs].index(job)]
+
+    def running(self):
+        """Return the priority and share of each running job."""
+        with self.lock:
+            jobs = self._jobs()
+        shares = fair_shares(self.cores, [entry for _, entry in jobs])
+        return [{"priority": entry[0], "share": share}
+                for (_, entry), share in zip(jobs, shares)]
+
+    def _jobs(self):
+        """Return the index and entry of every running job."""
+        return [(job, (self.priorities[job], self.limits[job],
+                       self.joined[job]))
+                for job in range(len(self.priorities))
+                if self.priorities[job] > 0]
+
+
+def fair_shares(cores, jobs):
+    """Share out cores between jobs given as (priority, limit, joined).
+
+    Up to one job per core is given a core, in order of priority and then of
+    joining, and the others wait for one. The remaining cores are handed
+    out one at a time to the job with the fewest for its priority that can
+    use more. Returns the number of cores for each job, in the same order.
+    """
+    order = sorted(range(len(jobs)), key=lambda i: (-jobs[i][0], jobs[i][2]))
+    running = order[:cores]
+    shares = [0] * len(jobs)
+    for i in running:
+        shares[i] = 1
+    free = cores - len(running)
+    while free > 0:
+        hungry = [i for i in running if shares[i] < jobs[i][1]]
+        if len(hungry) == 0:
+            break
+        i = min(hungry, key=lambda i: shares[i] / float(jobs[i][0]))
+        shares[i] += 1
+        free -= 1
+    return shares
+
+
+class SharedPool(object):
+    """A pool sized to the share of the machine's cores given to a job.
+
+    The share is looked up as each block starts. If it has changed, a pool
+    of the new size takes over and the old one is closed once it finishes
+    the blocks it has. Blocks wait while the job has no cores at all.
+    """
+
+    def __init__(self, slots, module_name, options, cores):
+        """Make pools for a project using up to `cores` cores."""
+        self.slots = slots
+        self.module_name = module_name
+        self.options = options
+        self.cores = cores
+        # The job's entry in `slots`, which is None for an unshared pool.
+        self.job = None
+        self.pool = None
+        self.size = 0
+        self.retired = []
+
+    def map_async(self, function, iterable):
+        """Start work on the pool, resizing it to the job's share first."""
+        share = self.cores
+        if self.job is not None:
+            share = self.slots.share(self.job)
+            while share == 0:
+                time.sleep(SLOT_POLL)
+                share = self.slots.share(self.job)
+        size = concurrency(self.cores, self.options, share)
+        if size != self.size:
+            if self.pool is not None:
+                self.pool.close()
+                self.retired.append(self.pool)
+            self.pool = make_pool(size, self.module_name, self.options)
+            self.size = size
+        return self.pool.map_async(function, iterable)
+
+    def reap(self):
+        """Wait for the pools that have been replaced to exit."""
+        for pool in self.retired:
+            pool.join()
+        self.retired = []
+
+    def close(self):
+        """Close every pool."""
+        for pool in self._pools():
+            pool.close()
+
+    def terminate(self):
+        """Stop every pool straight away."""
+        for pool in self._pools():
+            pool.terminate()
+
+    def join(self):
+        """Wait for the workers of every pool to exit."""
+        for pool in self._pools():
+            pool.join()
+        self.retired = []
+
+    def _pools(self):
+        """Return the current pool, if there is one, and the retired ones."""
+        return self.retired + ([] if self.pool is None else [self.pool])
+
+
+def file_signature(directory):
+    """Return the names, sizes and modification times of deployed files."""
+    signature = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if name != "__pycache__")
+        for name in sorted(files):
+            if name in ("log.txt", SHARED_DIGESTS):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            signature.append([path, stat.st_size, stat.st_mtime])
+    return signature
+
+
+def serve_project(connection, directory, cpus, module_name, function_name,
+                  slots, busy):
+    """Run the jobs for a project that the agent hands over.
+
+    The module stays imported and the pool stays running between jobs. It is
+    only restarted when a job needs a different executor or setup or
+    teardown functions, after a job that ended in an error or when the
+    job's share of `slots` changes. `busy` is cleared after each job.
+    """
+    global PROJECT
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    PROJECT = directory
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    function = getattr(__import__(module_name), function_name)
+    limit = cpus
+    if cpus == 0:
+        cpus = multiprocessing.cpu_count()
+
+    pool = None
+    hooks = None
+    with open("log.txt", "a") as f:
+        try:
+            while connection.recv() is not None:
+                fd = multiprocessing.reduction.recv_handle(connection)
+                sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+                os.close(fd)
+                instream = sock.makefile("rb")
+                outstream = sock.makefile("wb")
+                job = None
+                try:
+                    channel = open_channel(instream, outstream, cpus)
+                    print("job: " + json.dumps(channel.options), file=f)
+                    f.flush()
+                    options = channel.options
+                    needs = [options.get(name) for name in (
+                        "setup", "teardown", "executor", "concurrency",
+                        "shared", "profile")]
+                    if pool is None or hooks != needs:
+                        if pool is not None:
+                            finish_pool(pool)
+                        pool = SharedPool(slots, module_name, options, cpus)
+                        hooks = needs
+                    if options.get("profile"):
+                        start_profiler("controller")
+                    job = slots.join(options.get("priority", 1), limit)
+                    pool.job = job
+                    serve(channel, pool, function,
+                          concurrency(cpus, options), f)
+                    pool.reap()
+                except Exception as error:
+                    # Blocks the host gave up on would hold up the next job,
+                    # as would the rest of a job whose function failed.
+                    print("job failed: " + repr(error), file=f)
+                    f.flush()
+                    if pool is not None:
+                        pool.terminate()
+                        pool.join()
+                        pool = None
+                finally:
+                    if PROFILER is not None:
+                        stop_profiler()
+                    if job is not None:
+                        slots.leave(job)
+                    busy.value = 0
+                    try:
+                        # Pool workers and the agent's later children hold
+                        # copies of the socket, so closing ours isn't
+                        # enough to end the session.
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except (IOError, OSError):
+                        pass
+                    for stream in (instream, outstream, sock):
+                        try:
+                            stream.close()
+                        except (IOError, OSError):
+                            pass
+        finally:
+            if pool is not None:
+                finish_pool(pool)
+
+
+def open_channel(instream, outstream, cpus=0):
+    """Negotiate the protocol with the host and return a channel for it.
+
+    The host is told how many cpus the controller is using.
+    """
+    line = instream.readline().strip()
+    if not line or line == b"end":
+        return JsonChannel(instream, outstream, [])
+    message = json.loads(line.decode("utf-8"))
+    hello = message.get("hello")
+    if hello is None or hello.get("protocol") != PROTOCOL:
+        return JsonChannel(instream, outstream, [message])
+
+    compression = hello.get("compression")
+    if compression != "zlib":
+        compression = None
+    timings = bool(hello.get("timings"))
+    # Shared data files that differ from the host's copies.
+    shared = hello.get("options", {}).get("shared", {})
+    digests = shared_digests(PROJECT, sorted(shared))
+    stale = sorted(name for name in shared if digests[name] != shared[name])
+    reply = {"hello": {
+        "protocol": PROTOCOL, "compression": compression, "cpus": cpus,
+        "timings": timings, "values": True, "reduce": True,
+        "executors": executors(), "stale": stale,
+        "profile": can_profile()}}
+    outstream.write(json.dumps(reply).encode("utf-8") + b"\n")
+    outstream.flush()
+    channel = BinaryChannel(instream, outstream, compression, timings)
+    channel.options = hello.get("options", {})
+    return channel
+
+
+def executors():
+    """Return the executors that can run here."""
+    if asyncio is None:
+        return ["process", "thread"]
+    return ["process", "thread", "async"]
+
+
+class JsonChannel(object):
+    """Exchange one json message per line, as older hosts expect."""
+
+    name = "json"
+    options = {}
+    # Hosts that speak json only end the session once they have every
+    # result, so blocks still running are finished first.
+    abandons = False
+
+    def __init__(self, instream, outstream, pending):
+        """Use the given streams, replaying already read messages first."""
+        self.instream = instream
+        self.outstream = outstream
+        self.pending = pending
+
+    def read_block(self):
+        """Return the next block's bounds and inputs, or None at the end.
+
+        Json blocks are always a range, so their inputs are None.
+        """
+        if self.pending:
+            message = self.pending.pop(0)
+        else:
+            line = self.instream.readline().strip()
+            if not line or line == b"end":
+                return None
+            message = json.loads(line.decode("utf-8"))
+        return (message["start"], message["stop"]), None
+
+    def write_result(self, bounds, values, timings=None):
+        """Send the results for the block with the given bounds.
+
+        Older hosts have no way to receive timings, so they are dropped.
+        """
+        out = list(zip(range(bounds[0], bounds[1]), values))
+        self.outstream.write(
+            json.dumps({"solution": out}).encode("utf-8") + b"\n")
+        self.outstream.flush()
+
+    def write_error(self, text):
+        """Send the traceback of an error in the function."""
+        self.outstream.write(
+            json.dumps({"error": text}).encode("utf-8") + b"\n")
+        self.outstream.flush()
+
+
+class BinaryChannel(object):
+    """Exchange length-prefixed binary frames.
+
+    `options` holds the project settings the host sent with its hello.
+    """
+
+    name = "binary"
+    options = {}
+    # Hosts end a binary session early to give up on the blocks still
+    # running.
+    abandons = True
+
+    def __init__(self, instream, outstream, compression, timings=False):
+        """Use the given streams, compressing results if asked to.
+
+        If `timings` is true each result is sent with the times for its
+        block.
+        """
+        self.instream = instream
+        self.outstream = outstream
+        self.timings = timings
+        self.compressor = None
+        if compression == "zlib":
+            self.compressor = zlib.compressobj()
+
+    def read_block(self):
+        """Return the next block's bounds and inputs, or None at the end.
+
+        The inputs are None for a block of range(start, stop).
+        """
+        header = self.instream.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        payload = self.instream.read(HEADER.unpack(header)[0])
+        if payload[:1] == BLOCK:
+            return BOUNDS.unpack(payload[1:]), None
+        if payload[:1] == VALUES:
+            return (BOUNDS.unpack(payload[1:BOUNDS.size + 1]),
+                    decode_values(payload[BOUNDS.size + 1:]))
+        return None
+
+    def write_result(self, bounds, values, timings=(0.0, 0.0, 0.0)):
+        """Send the results for the block with the given bounds.
+
+        `timings` are the seconds the pool was idle before the block, the
+        block waited and the block ran, which are sent if the host asked.
+        """
+        began = time.time()
+        payload = encode_values(values)
+        if self.compressor is not None:
+            payload = (self.compressor.compress(payload)
+                       + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        if self.timings:
+            payload = TIMINGS.pack(
+                *(tuple(timings) + (time.time() - began,))) + payload
+        self.outstream.write(pack_frame(payload))
+        self.outstream.flush()
+
+    def write_profile(self, samples):
+        """Send the samples of a profile after the last result."""
+        self._write_notice({"profile": samples})
+
+    def write_error(self, text):
+        """Send the traceback of an error in the function."""
+        self._write_notice({"error": text})
+
+    def _write_notice(self, message):
+        """Send a json message that isn't a result.
+
+        An empty frame, which no result is sent as, marks the message.
+        """
+        self.outstream.write(pack_frame(b"") + pack_frame(
+            zlib.compress(json.dumps(message).encode("utf-8"))))
+        self.outstream.flush()
+
+
+def pack_frame(payload):
+    """Prefix a payload with its length."""
+    return HEADER.pack(len(payload)) + payload
+
+
+def pack_block(start, stop):
+    """Return the frame that asks for the results of range(start, stop)."""
+    return pack_frame(BLOCK + BOUNDS.pack(start, stop))
+
+
+def pack_values(start, stop, inputs):
+    """Return the frame asking for the results of a list of inputs."""
+    return pack_frame(
+        VALUES + BOUNDS.pack(start, stop) + encode_values(inputs))
+
+
+def pack_end():
+    """Return the frame that tells the controller to shut down."""
+    return pack_frame(END)
+
+
+def encode_values(values):
+    """Encode a list of results as compactly as their types allow."""
+    values = list(values)
+    if all(type(value) is int for value in values):
+        try:
+            return INTS + struct.pack("<%dq" % len(values), *values)
+        except struct.error:
+            pass
+    elif all(type(value) is float for value in values):
+        return FLOATS + struct.pack("<%dd" % len(values), *values)
+    return JSON + json.dumps(values).encode("utf-8")
+
+
+def decode_values(payload):
+    """Decode a list of results produced by encode_values."""
+    kind, body = payload[:1], payload[1:]
+    if kind == INTS:
+        return list(struct.unpack("<%dq" % (len(body) // 8), body))
+    if kind == FLOATS:
+        return list(struct.unpack("<%dd" % (len(body) // 8), body))
+    return json.loads(body.decode("utf-8"))
 
 
 if __name__ == '__main__':
-    cpus = int(sys.argv[1])
-    module_name = sys.argv[2]
-    function_name = sys.argv[3]
+    if sys.argv[1] == "--agent":
+        if sys.argv[2] == "start":
+            start_agent(int(sys.argv[3]))
+        else:
+            request_agent(int(sys.argv[3]), sys.argv[2])
+    elif sys.argv[1] == "--connect":
+        connect(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4], sys.argv[5])
+    else:
+        cpus = int(sys.argv[1])
+        module_name = sys.argv[2]
+        function_name = sys.argv[3]
 
-    main(cpus, module_name, function_name)
+        main(cpus, module_name, function_name)
@@ -2,7 +2,22 @@
 
 All tests should be run in Python 2 using python2 -m pytest
 """
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+
+import pytest
+
 import cerberus
+import controller
 
 
 def test_list(capsys, test_case):
@@ -43,3 +58,673 @@ def test_remove_file(capsys, test_case):
     messeges, _ = capsys.readouterr()
     assert messeges.strip() == expected_output
     assert set(processed_data["files"]) == set(expected_files)
+
+
+def test_upload_args(test_case):
+    """Test that a deploy pushes every file in a single transfer."""
+    data = test_case["data"]
+    for server in data["remotes"]:
+        rsync_args = cerberus._upload_args(server, data)
+        assert rsync_args[0] == "rsync"
+        assert rsync_args[-1] == (
+            server["user"] + "@" + server["location"] + ":.cerberus/"
+            + data["name"] + "/")
+        assert data["file"] + ".py" in rsync_args
+        for name in data["files"]:
+            assert name in rsync_args
+
+
+def test_ssh_command(tmpdir, monkeypatch):
+    """Test that ssh and rsync share one master connection per server."""
+    monkeypatch.setenv("HOME", str(tmpdir))
+    monkeypatch.setattr(cerberus, "_ssh_sessions", {})
+    server = {"user": "hal", "location": "127.0.0.1", "name": "skynet"}
+    control = str(tmpdir.join(".cerberus", "ssh", "%C"))
+    assert cerberus._ssh_command(server, 30) == [
+        "ssh", "-o", "ControlMaster=auto", "-o", "ControlPath=" + control,
+        "-o", "ControlPersist=30", "hal@127.0.0.1"]
+    assert tmpdir.join(".cerberus", "ssh").check(dir=True)
+    assert cerberus._ssh_sessions == {"hal@127.0.0.1": 30}
+    # A persist window of 0 still multiplexes, and is closed at exit.
+    assert "ControlPersist=1" in cerberus._ssh_command(server, 0)
+    assert cerberus._ssh_sessions == {"hal@127.0.0.1": 0}
+
+    data = {"name": "demo", "file": "work", "files": ["table.bin"],
+            "ssh_persist": 30}
+    rsync_args = cerberus._upload_args(server, data)
+    ssh = rsync_args[rsync_args.index("-e") + 1]
+    assert shlex.split(ssh) == cerberus._ssh_command(server, 30)[:-1]
+    assert "--rsync-path=mkdir -p .cerberus/demo && rsync" in rsync_args
+    assert rsync_args[-1] == "hal@127.0.0.1:.cerberus/demo/"
+
+
+def test_encode_values():
+    """Test that results survive the binary protocol unchanged."""
+    for values in ([], [1, -2, 3 ** 30], [0.5, 2.0], [1, "a", None, [2]],
+                   [True, False], [2 ** 70]):
+        payload = controller.encode_values(values)
+        assert controller.decode_values(payload) == values
+
+
+def test_stream_reader():
+    """Test reading frames and lines that arrive in pieces."""
+    read_end, write_end = os.pipe()
+    stream = os.fdopen(read_end, "rb")
+    reader = cerberus._StreamReader(stream)
+    header = controller.HEADER
+    try:
+        frame = header.pack(5) + b"hello"
+        os.write(write_end, frame[:3])
+        assert reader.read_frame(header, 0.01) is None
+        os.write(write_end, frame[3:] + header.pack(0))
+        assert reader.read_frame(header, 0.01) == b"hello"
+        assert reader.read_frame(header, 0.01) == b""
+
+        # Controllers older than the framed protocol end lines with a "$".
+        os.write(write_end, b'\n{"solution": [[0, 1], [1, 2]]}')
+        assert reader.read_line(0.01) is None
+        os.write(write_end, b'$\n')
+        line = reader.read_line(0.01)
+        assert line.endswith(b"$")
+        assert cerberus._Session(controller)._parse_line(line) == [1, 2]
+    finally:
+        os.close(write_end)
+    with pytest.raises(EOFError):
+        reader.read_line(0.01)
+    stream.close()
+
+
+def test_window():
+    """Test that the run's window overrides the one set for a server."""
+    parser = cerberus.create_parser()
+    args = parser.parse_args(["run", "10", "out.json"])
+    assert cerberus._window({"window": 5}, args) == 5
+    assert cerberus._window({}, args) == cerberus.WINDOW
+    args = parser.parse_args(["run", "10", "out.json", "-w", "3"])
+    assert cerberus._window({"window": 5}, args) == 3
+
+
+def test_scheduler_covers_range():
+    """Test that the adaptive scheduler hands out every value once."""
+    scheduler = cerberus._Scheduler([(5, 10000)])
+    scheduler.register("fast", 8)
+    scheduler.register("slow", 1)
+    covered = []
+    for name, rate in [("fast", 8000.0), ("slow", 100.0)] * 1000:
+        block = scheduler.take(name)
+        if block is not None:
+            low, high = block[1]
+            covered.append((low, high))
+            scheduler.done(name, block[0], high - low, (high - low) / rate)
+    covered.sort()
+    assert covered[0][0] == 5 and covered[-1][1] == 10000
+    assert all(a[1] == b[0] for a, b in zip(covered, covered[1:]))
+
+
+def test_scheduler_takes_over_small_reservations():
+    """Test that a stuck worker's last few values go to an idle worker."""
+    scheduler = cerberus._Scheduler([(0, 20)])
+    scheduler.register("stuck", 1)
+    scheduler.register("idle", 0)
+    scheduler.resize("idle", 4)
+    assert scheduler.workers["idle"]["cores"] == 4
+    scheduler.take("stuck")
+    scheduler.workers["stuck"]["reserve"] = [18, 20]
+    scheduler.unreserved = 0
+    scheduler.ranges.clear()
+    assert scheduler.take("idle")[1] == (18, 20)
+    assert scheduler.workers["stuck"]["reserve"] == [18, 18]
+
+
+def test_block_cursor():
+    """Test that fixed size blocks are worked out without a queue."""
+    cursor = cerberus._BlockCursor([(3, 10 ** 12)], 1000)
+    cursor.register("local", 1)
+    assert cursor.total_blocks == 10 ** 9
+    assert cursor.take("local") == (0, (3, 1003))
+    assert cursor.take("local") == (1, (1003, 2003))
+    cursor.next_block = cursor.total_blocks - 1
+    assert cursor.take("local")[1] == (10 ** 12 - 997, 10 ** 12)
+    assert cursor.take("local") is None
+
+
+def test_sinks(tmpdir):
+    """Test that blocks arriving out of order are written correctly."""
+    parser = cerberus.create_parser()
+    for name in ["out.json", "out.jsonl", "out.npy"]:
+        output = str(tmpdir.join(name))
+        args = parser.parse_args(["run", "-s", "2", "8", output])
+        source = cerberus._open_source(args)
+        with cerberus._open_sink(args, source, {}) as sink:
+            sink.write((5, 8), [25, 36, 49])
+            sink.write((2, 5), [4, 9, 16])
+        if name == "out.json":
+            results = json.load(open(output))
+            assert results == {str(i): i * i for i in range(2, 8)}
+        elif name == "out.jsonl":
+            results = [json.loads(line) for line in open(output)]
+            assert sorted(results) == [[i, i * i] for i in range(2, 8)]
+        else:
+            raw = open(output, "rb").read()
+            header_length = struct.unpack("<H", raw[8:10])[0]
+            header = ast.literal_eval(raw[10:10 + header_length].decode())
+            assert header["shape"] == (6,) and header["descr"] == "<i8"
+            assert (10 + header_length) % 64 == 0
+            body = raw[10 + header_length:]
+            assert struct.unpack("<6q", body) == tuple(
+                i * i for i in range(2, 8))
+
+
+def test_array_sink_types(tmpdir):
+    """Test that an array switches to floats and rejects what won't fit."""
+    parser = cerberus.create_parser()
+    output = str(tmpdir.join("out.npy"))
+    args = parser.parse_args(["run", "4", output])
+    with cerberus._open_sink(args, cerberus._open_source(args), {}) as sink:
+        sink.write((0, 2), [1, 2])
+        sink.write((2, 4), [0.5, 3])
+    raw = open(output, "rb").read()
+    header_length = struct.unpack("<H", raw[8:10])[0]
+    assert b"'<f8'" in raw[10:10 + header_length]
+    assert struct.unpack("<4d", raw[10 + header_length:]) == (1, 2, 0.5, 3)
+
+    for extra, values in [([], [2 ** 70]), (["--dtype", "int64"], [0.5]),
+                          ([], ["word"])]:
+        args = parser.parse_args(["run", "1", output] + extra)
+        sink = cerberus._open_sink(args, cerberus._open_source(args), {})
+        with pytest.raises(cerberus._SinkError):
+            sink.write((0, 1), values)
+        sink.close()
+
+
+def test_sources(tmpdir, monkeypatch):
+    """Test that inputs other than a range are found by their position."""
+    parser = cerberus.create_parser()
+    args = parser.parse_args(["run", "out.json", "--grid", "a=0:3",
+                              "--grid", "b=x,2.5"])
+    source = cerberus._open_source(args)
+    assert source.span == (0, 6)
+    assert source.inputs((2, 4)) == [{"a": 1, "b": "x"}, {"a": 1, "b": 2.5}]
+
+    args = parser.parse_args(["run", "-s", "1", "10", "out.json",
+                              "--step", "4"])
+    source = cerberus._open_source(args)
+    assert source.span == (0, 3) and source.shipped((1, 3)) == [5, 9]
+
+    monkeypatch.setattr(cerberus, "FILE_INDEX", 2)
+    path = tmpdir.join("inputs.txt")
+    path.write("1\n\nword\n[2, 3]\n{\"k\": null}\n")
+    args = parser.parse_args(["run", "out.json", "--input", str(path)])
+    source = cerberus._open_source(args)
+    assert source.span == (0, 4)
+    assert source.inputs((1, 4)) == ["word", [2, 3], {"k": None}]
+    assert source.inputs((0, 1)) == [1]
+
+
+def test_block_cursor_gaps():
+    """Test that fixed size blocks only cover the ranges asked for."""
+    cursor = cerberus._BlockCursor([(0, 5), (10, 13)], 2)
+    cursor.register("local", 1)
+    blocks = [cursor.take("local") for _ in range(6)]
+    assert blocks == [(0, (0, 2)), (1, (2, 4)), (2, (4, 5)), (3, (10, 12)),
+                      (4, (12, 13)), None]
+
+
+def test_missing_ranges():
+    """Test working out which parts of a run still need to be done."""
+    finished = [(20, 30), (0, 5), (5, 10)]
+    assert cerberus._missing_ranges(0, 40, finished) == [(10, 20), (30, 40)]
+    assert cerberus._missing_ranges(0, 10, finished[1:]) == []
+
+
+def test_resume_keeps_output(tmpdir, monkeypatch):
+    """Test that a resume that can't go ahead leaves the output alone."""
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("r.jsonl").write("[0, 0]\n[1, 1]\n")
+    data = {"file": "work", "function": "square", "files": [],
+            "remotes": [], "local": True}
+    parser = cerberus.create_parser()
+    args = parser.parse_args(["run", "2", "r.jsonl", "--resume"])
+    with pytest.raises(SystemExit, match="No unfinished run"):
+        cerberus.run(args, data)
+    assert tmpdir.join("r.jsonl").read() == "[0, 0]\n[1, 1]\n"
+
+    journal = cerberus._Journal(controller, parser.parse_args(
+        ["run", "3", "r.jsonl"]))
+    journal.create()
+    journal.close(False)
+    with pytest.raises(SystemExit, match="different arguments"):
+        cerberus.run(args, data)
+    assert tmpdir.join("r.jsonl").read() == "[0, 0]\n[1, 1]\n"
+
+
+def test_failed_worker_blocks_are_retried():
+    """Test that blocks held by a worker that stops are handed out again."""
+    scheduler = cerberus._BlockCursor([(0, 30)], 10)
+    scheduler.register("a", 1)
+    scheduler.register("b", 1)
+    first = scheduler.take("a")
+    second = scheduler.take("b")
+    scheduler.release("a", "lost connection")
+    assert scheduler.take("b") == first
+    assert scheduler.done("b", second[0], 10, 1.0)
+    assert scheduler.done("b", first[0], 10, 1.0)
+    assert not scheduler.finished()
+    assert scheduler.take("b")[1] == (20, 30)
+    assert len(scheduler.report()["a"]) == 1
+
+
+def test_speculative_copy():
+    """Test that an idle worker gets a copy of the last running block."""
+    scheduler = cerberus._BlockCursor([(0, 10)], 10)
+    scheduler.register("slow", 1)
+    scheduler.register("fast", 1)
+    block = scheduler.take("slow")
+    assert scheduler.take("fast") == block
+    assert scheduler.done("fast", block[0], 10, 1.0)
+    assert not scheduler.done("slow", block[0], 10, 5.0)
+    assert scheduler.finished()
+
+
+def test_expired_lease():
+    """Test that a block whose lease ran out goes to another worker."""
+    scheduler = cerberus._BlockCursor([(0, 30)], 10, timeout=5)
+    scheduler.register("slow", 1)
+    scheduler.register("fast", 1)
+    block = scheduler.take("slow")
+    scheduler.leases[block[0]]["deadline"] = 0
+    scheduler.expire()
+    assert scheduler.take("slow")[1] == (10, 20)
+    assert scheduler.take("fast") == block
+    assert len(scheduler.report()["slow"]) == 1
+
+    scheduler.leases[block[0]]["deadline"] = 0
+    scheduler.expire()
+    scheduler.release("fast", "lost connection")
+    assert scheduler.take("slow") == block
+
+
+def test_result_cache(tmpdir, monkeypatch):
+    """Test that cached results are reused until the code changes."""
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv("HOME", str(tmpdir))
+    tmpdir.join("work.py").write("def square(n):\n    return n * n\n")
+    data = {"file": "work", "function": "square", "files": []}
+    path = str(tmpdir.join("cache.sqlite"))
+
+    cache = cerberus._ResultCache(controller, data, path)
+    cache.store((0, 4), [0, 1, 4, 9])
+    cache.store((10, 12), [100, 121])
+    cache.close()
+
+    cache = cerberus._ResultCache(controller, data, path)
+    hits = list(cache.lookup([(2, 11), (20, 30)]))
+    cache.close()
+    assert hits == [((2, 4), [4, 9]), ((10, 11), [100])]
+
+    # An edit that keeps the size and modification time is still seen.
+    stat = os.stat("work.py")
+    tmpdir.join("work.py").write("def square(n):\n    return (n*n)\n")
+    os.utime("work.py", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    cache = cerberus._ResultCache(controller, data, path)
+    assert list(cache.lookup([(0, 20)])) == []
+    cache.close()
+    assert str(tmpdir.join("work.py")) in json.loads(
+        tmpdir.join(".cerberus", "digests.json").read())
+    assert not tmpdir.join(controller.SHARED_DIGESTS).check()
+
+    cache = cerberus._ResultCache(controller, data, path)
+    cache.store((0, 4), [0, 1, 4, 9])
+    cache.close()
+    for name, value in (("mode", "batch"), ("setup", "connect"),
+                        ("executor", "thread")):
+        cache = cerberus._ResultCache(
+            controller, dict(data, **{name: value}), path)
+        assert list(cache.lookup([(0, 4)])) == []
+        cache.close()
+
+
+def test_async_connection(tmpdir):
+    """Test a session with a controller driven by asyncio."""
+    tmpdir.join("work.py").write("def square(n):\n    return n * n\n")
+    shutil.copy(controller.__file__, str(tmpdir))
+
+    async def session():
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "controller.py", "1", "work", "square",
+            cwd=str(tmpdir), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        conn = cerberus._AsyncConnection(proc, controller)
+        await conn.negotiate(True, {})
+        conn.send_block((2, 5))
+        conn.send_block((0, 2), [7, 8])
+        await conn.flush()
+        results = [await conn.read_result(), await conn.read_result()]
+        conn.close()
+        await proc.wait()
+        return conn.protocol, results
+
+    assert asyncio.run(session()) == ("binary", [[4, 9, 16], [49, 64]])
+
+
+def test_function_error(tmpdir):
+    """Test that an error in the function is sent to the host."""
+    tmpdir.join("work.py").write(
+        "def check(n):\n    if n == 3:\n        raise ValueError(n)\n"
+        "    return n\n")
+    shutil.copy(controller.__file__, str(tmpdir))
+
+    async def session():
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "controller.py", "1", "work", "check",
+            cwd=str(tmpdir), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        conn = cerberus._AsyncConnection(proc, controller)
+        await conn.negotiate(False, {})
+        conn.send_block((0, 2))
+        conn.send_block((2, 4))
+        await conn.flush()
+        first = await conn.read_result()
+        with pytest.raises(cerberus._FunctionError) as error:
+            await conn.read_result()
+        conn.close()
+        await asyncio.wait_for(conn.wait_closed(), 10)
+        return first, str(error.value), await proc.stderr.read()
+
+    first, text, errors = asyncio.run(session())
+    assert first == [0, 1]
+    assert "ValueError: 3" in text
+    assert b"Fatal" not in errors
+
+
+def test_negotiate_with_old_controller():
+    """Test that controllers without the binary protocol keep json lines."""
+    # What controllers from before the binary protocol answer a hello with.
+    script = ("import sys\nsys.stdin.readline()\n"
+              "print('{\"solution\": []}$')\nsys.stdout.flush()\n"
+              "sys.stdin.readline()\n")
+
+    async def session():
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", script, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        conn = cerberus._AsyncConnection(proc, controller)
+        protocol = await conn.negotiate(True, {})
+        conn.close()
+        await proc.wait()
+        return protocol
+
+    assert asyncio.run(session()) == "json"
+
+    proc = subprocess.Popen([sys.executable, "-c", script],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    conn = cerberus._Connection(proc, controller)
+    conn.negotiate(False, {})
+    conn.close()
+    proc.wait()
+    assert conn.protocol == "json" and conn.cpus is None
+
+
+def test_batch_split():
+    """Test that batch chunks cover a block exactly."""
+    assert controller.split((0, 10), 3) == [(0, 3), (3, 6), (6, 10)]
+    assert controller.split((5, 7), 8) == [(5, 6), (6, 7)]
+    assert controller.run_batch(lambda a, b: range(a, b), (2, 5)) == [2, 3, 4]
+
+
+def test_reduce(tmpdir):
+    """Test that chunks are reduced in workers and blocks on the host."""
+    assert controller.run_reduced(
+        lambda n: n * n, max, "single", ((0, 5), None)) == 16
+    assert controller.run_reduced(
+        lambda n: n if n % 2 else None, None, "single", ((0, 5), None)) == [
+            [1, 1], [3, 3]]
+    assert controller.run_reduced(
+        lambda values: [len(v) for v in values], None, "batch",
+        ((0, 2), ["a", "bb"])) == [["a", 1], ["bb", 2]]
+
+    output = str(tmpdir.join("out.json"))
+    args = cerberus.create_parser().parse_args(["run", "4", output])
+    source = cerberus._open_source(args)
+    with cerberus._ReduceSink(args, source, lambda a, b: a + b) as sink:
+        sink.write((2, 4), [5])
+        sink.write((0, 2), [1])
+    assert json.load(open(output)) == 6
+    with cerberus._JsonSink(args, source, filtered=True) as sink:
+        sink.write((0, 2), [])
+        sink.write((2, 4), [[3, "x"]])
+    assert json.load(open(output)) == {"3": "x"}
+
+
+def test_worker_setup(monkeypatch):
+    """Test that the setup state is passed to the function."""
+    monkeypatch.setattr(controller, "WORKER_ARGS", ({"offset": 10},))
+    assert controller.run_value(lambda n, state: n + state["offset"], 1) == 11
+    monkeypatch.setattr(controller, "SETUP_ERROR", IOError("missing"))
+    with pytest.raises(IOError):
+        controller.run_value(lambda n, state: n, 1)
+
+
+def test_calibration():
+    """Test that calibration is fitted and seeds the scheduler."""
+    parser = cerberus.create_parser()
+    args = parser.parse_args(["calibrate", "-r"])
+    with pytest.raises(SystemExit, match="No servers added"):
+        cerberus.calibrate(args, {"remotes": []})
+
+    samples = [(size, 0.5 + size / 400.0) for size in (100, 200, 400)]
+    measured = cerberus._fit(samples, 4)
+    assert measured["cores"] == 4
+    assert abs(measured["rate"] - 100) < 1e-6
+    assert abs(measured["overhead"] - 0.5) < 1e-6
+
+    scheduler = cerberus._Scheduler([(0, 100000)])
+    scheduler.register(
+        "server", 0, {"cores": 4, "rate": 100.0, "overhead": 0.5})
+    assert scheduler.workers["server"]["cores"] == 4
+    # blocks are sized to the measured rate from the first one
+    _, bounds = scheduler.take("server")
+    assert bounds[1] - bounds[0] == 400 * cerberus.OVERHEAD_FACTOR * 0.5
+
+
+def test_summarize_metrics(tmpdir, monkeypatch, capsys):
+    """Test that stats adds up block timings and finds stragglers."""
+    records = [
+        {"event": "start", "time": 0.0, "workers": ["a", "b", "c"]},
+        {"event": "block", "time": 4.0, "worker": "a", "bounds": [0, 10],
+         "first": True, "write": 0.5, "compute": 3.0, "network": 1.0},
+        {"event": "block", "time": 4.0, "worker": "b", "bounds": [10, 20],
+         "first": True, "write": 0.5, "compute": 4.0},
+        {"event": "block", "time": 9.0, "worker": "c", "bounds": [20, 30],
+         "first": True, "write": 0.5, "compute": 9.0},
+        {"event": "block", "time": 10.0, "worker": "a", "bounds": [20, 30],
+         "first": False, "compute": 5.0},
+        {"event": "end", "time": 10.0, "failures": {"a": ["lost"]}},
+    ]
+    summary = cerberus._summarize(records)
+    assert summary["wall"] == 10.0
+    assert summary["values"] == 30
+    assert summary["workers"]["a"]["compute"] == 8.0
+    assert summary["workers"]["a"]["wasted"] == 10
+    assert summary["stragglers"] == [("c", 5.0)]
+    assert summary["failures"] == {"a": ["lost"]}
+
+    # Each run has metrics of its own, and stats shows the latest.
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("old.json" + cerberus.METRICS).write("")
+    tmpdir.join("old.json" + cerberus.METRICS).setmtime(0)
+    tmpdir.join("new.json" + cerberus.METRICS).write(
+        "\n".join(json.dumps(record) for record in records))
+    parser = cerberus.create_parser()
+    cerberus.stats(parser.parse_args(["stats"]), {})
+    assert capsys.readouterr()[0].startswith("10.0s to run")
+    with pytest.raises(SystemExit, match="No run found"):
+        cerberus.stats(parser.parse_args(["stats", "old.json"]), {})
+
+
+def test_local_transport(tmpdir, monkeypatch):
+    """Test that local workers are deployed and run in their directory."""
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("work.py").write("def square(n):\n    return n * n\n")
+    tmpdir.join("controller.py").write("")
+    data = {"name": "demo", "file": "work", "files": [], "local": True}
+    server = {"transport": "local", "name": "w0",
+              "location": str(tmpdir.join("w0"))}
+    transport = cerberus._transport(server, data)
+    assert transport.upload() is None
+    assert tmpdir.join("w0", ".cerberus", "demo", "work.py").check()
+    code, _, _ = transport.call(["rm", "-rf", ".cerberus/demo"])
+    assert code == 0
+    assert not tmpdir.join("w0", ".cerberus", "demo").check()
+
+
+def test_file_signature(tmpdir):
+    """Test that agents reload a project only when its files change."""
+    tmpdir.join("work.py").write("def square(n):\n    return n * n\n")
+    signature = controller.file_signature(str(tmpdir))
+    tmpdir.join("log.txt").write("sent block: (0, 10)\n")
+    assert controller.file_signature(str(tmpdir)) == signature
+    tmpdir.join("work.py").write("def square(n):\n    return n ** 2\n")
+    assert controller.file_signature(str(tmpdir)) != signature
+
+
+def test_fair_shares():
+    """Test that agents share cores between jobs by priority."""
+    assert controller.fair_shares(8, [(1, 8, 0), (1, 8, 1)]) == [4, 4]
+    assert controller.fair_shares(8, [(3, 8, 0), (1, 8, 1)]) == [6, 2]
+    assert controller.fair_shares(8, [(1, 2, 0), (1, 8, 1)]) == [2, 6]
+    assert controller.fair_shares(
+        2, [(1, 8, 0), (1, 8, 1), (5, 8, 2)]) == [1, 0, 1]
+
+    slots = controller.Slots(4)
+    first = slots.join(1)
+    assert slots.share(first) == 4
+    second = slots.join(1)
+    assert slots.share(first) == slots.share(second) == 2
+    slots.leave(first)
+    assert slots.share(second) == 4
+    assert slots.running() == [{"priority": 1, "share": 4}]
+
+
+def test_shared_agent(tmpdir, monkeypatch, capsys):
+    """Test that projects sharing a server run their jobs on one agent."""
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    parser = cerberus.create_parser()
+    # Local workers are given the ports after the one asked for.
+    args = parser.parse_args(["agent", "start", "-p", str(port - 1)])
+    projects = []
+    try:
+        for name, body in (("first", "n * n"), ("second", "n + 1")):
+            monkeypatch.chdir(tmpdir.mkdir(name))
+            tmpdir.join(name, "work.py").write(
+                "def work(n):\n    return " + body + "\n")
+            shutil.copy(controller.__file__, str(tmpdir.join(name)))
+            server = {"transport": "local", "name": "w0", "cores": 1,
+                      "location": str(tmpdir.join("server"))}
+            data = {"name": name, "file": "work", "function": "work",
+                    "files": [], "local": True, "remotes": [server]}
+            projects.append(data)
+            assert cerberus._transport(server, data).upload() is None
+            cerberus.agent(args, data)
+            assert server["agent"] == port
+        assert "already running on port " + str(port) in (
+            capsys.readouterr().out.splitlines()[-1])
+        results = []
+        for data in projects:
+            proc = cerberus._start_controller(data["remotes"][0], data)
+            conn = cerberus._Connection(proc, controller)
+            conn.negotiate(False, {})
+            conn.send_block((2, 4))
+            results.append(conn.read_result((2, 4), 30))
+            conn.close()
+            proc.wait()
+        assert results == [[4, 9], [3, 4]]
+        cerberus.agent(parser.parse_args(["agent", "status"]), projects[0])
+        assert "2 project(s) loaded" in capsys.readouterr().out
+    finally:
+        # Even if the port was never recorded.
+        server = dict(projects[0]["remotes"][0], agent=port)
+        cerberus.agent(parser.parse_args(["agent", "stop"]),
+                       dict(projects[0], remotes=[server]))
+
+
+def test_executors():
+    """Test that functions run on thread pools and as coroutines."""
+    async def double(n):
+        await asyncio.sleep(0)
+        return n * 2
+
+    async def halves(start, stop):
+        return [n / 2 for n in range(start, stop)]
+
+    async def odd(n):
+        return n if n % 2 else None
+
+    options = {"executor": "async"}
+    assert controller.concurrency(2, options) == 128
+    assert controller.concurrency(8, {"concurrency": 100}, 2) == 25
+    pool = controller.make_pool(3, "json", options)
+    try:
+        assert controller.start_block(
+            pool, double, (0, 10), options, 3).get() == list(range(0, 20, 2))
+        assert controller.start_block(
+            pool, halves, (0, 4), dict(options, mode="batch"), 3).get() == [
+                0, 0.5, 1, 1.5]
+        assert controller.start_block(
+            pool, odd, (0, 4), dict(options, filter=True), 3,
+            [5, 6, 7, 8]).get() == [[5, 5], [7, 7]]
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+    options = {"executor": "thread"}
+    pool = controller.make_pool(4, "json", options)
+    assert controller.start_block(
+        pool, lambda n: n + 1, (0, 5), options, 4).get() == [1, 2, 3, 4, 5]
+    pool.close()
+    pool.join()
+
+
+def test_shared_data(tmpdir, monkeypatch):
+    """Test that shared data is mapped for workers and checked by digest."""
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(controller, "WORKER_ARGS", ())
+    tmpdir.join("table.bin").write_binary(b"abcdef")
+    signature = controller.file_signature(str(tmpdir))
+    digests = controller.shared_digests(
+        str(tmpdir), ["table.bin", "missing.bin"])
+    assert digests == {
+        "table.bin": hashlib.sha256(b"abcdef").hexdigest(),
+        "missing.bin": None}
+    assert tmpdir.join(controller.SHARED_DIGESTS).check()
+    assert controller.file_signature(str(tmpdir)) == signature
+
+    controller.set_up("json", None, None, {"table.bin": "table.bin"})
+    assert controller.run_value(lambda n, shared: shared["table.bin"][n:n + 2],
+                                1) == b"bc"
+    options = {"shared": {"table.bin": digests["table.bin"]},
+               "paths": {"table.bin": str(tmpdir.join("table.bin"))}}
+    assert controller.shared_paths(options) == {
+        "table.bin": str(tmpdir.join("table.bin"))}
+
+
+def test_profile():
+    """Test that stacks are sampled and reported by function."""
+    profiler = controller.Profiler("worker")
+    profiler.sample(None, sys._getframe())
+    samples = profiler.take()
+    assert any(stack.startswith("worker;")
+               and stack.endswith(";test_profile (test_main.py:" + str(
+                   test_profile.__code__.co_firstlineno) + ")")
+               for stack in samples)
+    assert profiler.take() is None
+
+    report = cerberus._profile_report({
+        "worker;main (a.py:1);f (a.py:3)": 3,
+        "controller;main (c.py:1);encode (c.py:9)": 1})
+    assert report[0] == "  by process: worker 75.0%, controller 25.0%"
+    assert report[2].split() == ["75.0%", "75.0%", "f", "(a.py:3)"]
+    assert report[3].split() == ["25.0%", "25.0%", "encode", "(c.py:9)"]